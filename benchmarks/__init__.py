@@ -0,0 +1,10 @@
+def latencySummary(samples):
+    """Percentiles in milliseconds of a list of durations in seconds."""
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+
+    def percentile(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 3)
+
+    return {"p50": percentile(0.50), "p90": percentile(0.90), "p99": percentile(0.99), "max": round(ordered[-1] * 1000, 3)}
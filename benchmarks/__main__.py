@@ -0,0 +1,50 @@
+"""Runs the whole benchmark suite and prints one JSON document to compare between commits.
+
+    python -m benchmarks --scale small --output results.json
+"""
+import argparse
+from datetime import datetime
+import json
+import subprocess
+import sys
+
+SCALES = {
+    "small": {"users": 200, "requests": 300, "concurrency": 16, "transfers": 20000},
+    "medium": {"users": 2000, "requests": 2000, "concurrency": 32, "transfers": 100000},
+    "large": {"users": 20000, "requests": 10000, "concurrency": 64, "transfers": 1000000},
+}
+
+def benchmark(module: str, *args):
+    # Each benchmark picks its own database before importing the app, so they run in separate processes.
+    output = subprocess.run([sys.executable, "-m", f"benchmarks.{module}", *map(str, args)], check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+def commit():
+    result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True)
+    return result.stdout.strip() or None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    parser.add_argument("--output", help="also write the results to this file")
+    args = parser.parse_args()
+    scale = SCALES[args.scale]
+
+    results = {
+        "commit": commit(),
+        "started_at": datetime.utcnow().isoformat(timespec="seconds"),
+        "scale": {"name": args.scale, **scale},
+        "api": benchmark("api_load", "--users", scale["users"], "--requests", scale["requests"],
+                         "--concurrency", scale["concurrency"], "--transfers", scale["transfers"] // 10),
+        "settlement": benchmark("settlement_throughput", "--transfers", scale["transfers"], "--accounts", scale["users"], "--workers", 1, "--workers", 4),
+        "writes": benchmark("write_throughput"),
+        "auth": benchmark("auth_overhead"),
+    }
+    document = json.dumps(results, indent=2)
+    print(document)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(document + "\n")
+
+if __name__ == "__main__":
+    main()
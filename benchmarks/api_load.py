@@ -0,0 +1,120 @@
+"""Latency and throughput of the main endpoints at a given concurrency.
+
+    python -m benchmarks.api_load --users 1000 --concurrency 32 --requests 2000
+
+Seeds a temporary database and calls the app in-process. With --url the
+requests go to a running server instead, whose database must have been seeded
+with the same --users and --accounts-per-user (python -m benchmarks.seed).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+directory = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+os.environ.pop("ASYNC_DATABASE_URL", None)
+
+import httpx
+import db
+from benchmarks import latencySummary
+from benchmarks.seed import SEED_PASSWORD, accountID, seed
+from iban import formatIban
+
+def scenarios(users: int, accounts_per_user: int, rng: random.Random):
+    """Each scenario builds the (method, path, json) of its i-th request."""
+    run_id = time.time_ns()
+
+    def user():
+        return rng.randrange(1, users + 1)
+
+    def other_iban(user_id):
+        target = user_id
+        while target == user_id:
+            target = user()
+        return formatIban(accountID(target, 0, accounts_per_user))
+
+    def transfer(i):
+        user_id = user()
+        return "POST", "/account/transfer", {"sold": "0.01", "name": "Principal", "iban": other_iban(user_id), "userID": user_id}
+
+    return {
+        "register": lambda i: ("POST", "/auth/register", {"name": f"load{i}", "email": f"load{run_id}-{i}@example.com", "password": SEED_PASSWORD}),
+        "login": lambda i: ("POST", "/auth/login", {"email": f"user{user()}@example.com", "password": SEED_PASSWORD}),
+        "deposit": lambda i: ("POST", "/account/deposit", {"sold": "1.00", "name": "Principal", "userID": user()}),
+        "transfer": transfer,
+        "transaction_logs": lambda i: ("POST", "/account/transaction_logs", {"name": "Principal", "userID": user(), "limit": 50}),
+        "accounts": lambda i: ("POST", "/accounts/", {"userID": user()}),
+    }
+
+async def drive(client: httpx.AsyncClient, name: str, build, requests: int, concurrency: int):
+    latencies, errors = [], 0
+    pending = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in pending:
+            method, path, body = build(i)
+            started = time.perf_counter()
+            response = await client.request(method, path, json=body)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400 or "error" in response.json():
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    return {
+        "scenario": name,
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(requests / elapsed, 1),
+        "latency_ms": latencySummary(latencies),
+    }
+
+async def run(args):
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=60)
+        seeded = None
+    else:
+        seeded = seed(db.engine, args.users, args.accounts_per_user, transfers=args.transfers, deposits=args.transfers)
+        from main import app
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=60)
+
+    selected = set(args.scenario or [])
+    results = []
+    async with client:
+        for name, build in scenarios(args.users, args.accounts_per_user, random.Random(args.seed)).items():
+            if selected and name not in selected:
+                continue
+            # Auth hashes with scrypt, a fraction of the requests is enough to measure it.
+            requests = max(1, args.requests // 10) if name in ("register", "login") else args.requests
+            results.append(await drive(client, name, build, requests, args.concurrency))
+    await db.async_engine.dispose()
+    return {"seed": seeded, "scenarios": results}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--accounts-per-user", type=int, default=2)
+    parser.add_argument("--transfers", type=int, default=10000, help="past transfers and deposits to seed")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--scenario", action="append", help="run only this scenario, can be repeated")
+    parser.add_argument("--url", help="base URL of a running server")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    try:
+        print(json.dumps(asyncio.run(run(args)), indent=2))
+    finally:
+        db.engine.dispose()
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
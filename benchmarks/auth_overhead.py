@@ -0,0 +1,59 @@
+"""Per-request cost of get_current_user with and without the principal cache.
+
+    python -m benchmarks.auth_overhead --requests 2000
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+
+directory = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+os.environ.pop("ASYNC_DATABASE_URL", None)
+
+from sqlmodel import SQLModel, Session
+from cache import TTLCache
+import db
+import utils
+
+async def measure(token: str, requests: int):
+    started = time.perf_counter()
+    for _ in range(requests):
+        async with db.open_async_session() as session:
+            await utils.get_current_user(token, session)
+    return (time.perf_counter() - started) / requests
+
+async def run(requests: int):
+    SQLModel.metadata.create_all(db.engine)
+    with Session(db.engine) as session:
+        user = db.User(name="bench", email="bench@example.com", password="x")
+        session.add(user)
+        session.commit()
+        token = utils.create_access_token(data={"sub": user.email, "uid": user.id, "name": user.name})
+
+    modes = [("database", 0, False), ("cache", utils.AUTH_CACHE_SIZE or 10000, False), ("trusted_claims", 0, True)]
+    results = []
+    for mode, cache_size, trust_claims in modes:
+        utils.principal_cache = TTLCache(cache_size)
+        utils.AUTH_TRUST_CLAIMS = trust_claims
+        await measure(token, 50)
+        per_request = await measure(token, requests)
+        results.append({"mode": mode, "requests": requests, "microseconds_per_request": round(per_request * 1e6, 1)})
+    await db.async_engine.dispose()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+    try:
+        print(json.dumps(asyncio.run(run(args.requests)), indent=2))
+    finally:
+        db.engine.dispose()
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""Fill a database with users, accounts, beneficiaries and past transfers.
+
+    python -m benchmarks.seed --database bench.db --users 10000
+
+Every user logs in with SEED_PASSWORD, account n (from 1) has IBAN formatIban(n)
+and users own consecutive accounts, so load drivers can pick targets without
+reading the database back. Balances, ledger, history and the daily activity
+totals agree, as after real use.
+"""
+import argparse
+from datetime import datetime, timedelta
+from decimal import Decimal
+import json
+import random
+import time
+from typing import NamedTuple
+from sqlalchemy import insert
+from sqlalchemy.engine import Engine
+from sqlmodel import SQLModel
+import db
+import migrations
+from iban import SEQUENCE_NAME, formatIban
+from money import fromCents
+from services.activity_service import activityRows, depositActivity, transferMovedActivity
+from services.ledger_service import postingEntries
+from services.password_service import hashPassword
+from services.settlement_service import applyTransfers
+
+SEED_PASSWORD = "benchmark-password"
+OPENING_BALANCE = Decimal(1000)
+HISTORY = timedelta(days=90)
+CHUNK_SIZE = 10000
+
+class SeedTransfer(NamedTuple):
+    id: int
+    sold: Decimal
+    sourceAccountID: int
+    targetAccountID: int
+    created_at: datetime
+
+def accountID(user_id: int, index: int, accounts_per_user: int):
+    return (user_id - 1) * accounts_per_user + index + 1
+
+def _insert(connection, model, rows):
+    for start in range(0, len(rows), CHUNK_SIZE):
+        connection.execute(insert(model), rows[start:start + CHUNK_SIZE])
+
+def seed(engine: Engine, users: int, accounts_per_user: int = 2, beneficiaries_per_user: int = 3,
+         transfers: int = 0, deposits: int = 0, random_seed: int = 0):
+    """Seeds an empty database and returns how many rows each table got and how fast."""
+    rng = random.Random(random_seed)
+    started = time.perf_counter()
+    SQLModel.metadata.create_all(engine)
+    migrations.migrate(engine)
+
+    now = datetime.utcnow()
+    password = hashPassword(SEED_PASSWORD)
+    account_count = users * accounts_per_user
+    user_rows = [{"id": i, "name": f"user{i}", "email": f"user{i}@example.com", "password": password} for i in range(1, users + 1)]
+    account_rows = [
+        {
+            "id": accountID(user_id, index, accounts_per_user),
+            "name": "Principal" if index == 0 else f"Account {index}",
+            "sold": OPENING_BALANCE,
+            "iban": formatIban(accountID(user_id, index, accounts_per_user)),
+            "userID": user_id,
+            "isMain": index == 0,
+            "created_at": now - HISTORY,
+        }
+        for user_id in range(1, users + 1)
+        for index in range(accounts_per_user)
+    ]
+    beneficiary_rows = [
+        {"name": f"Beneficiary {n}", "iban": formatIban(rng.randrange(1, account_count + 1)), "userID": user_id}
+        for user_id in range(1, users + 1)
+        for n in range(beneficiaries_per_user)
+    ]
+
+    def past():
+        return now - HISTORY * rng.random()
+
+    deposit_rows = []
+    for i in range(1, deposits + 1):
+        account_id = rng.randrange(1, account_count + 1)
+        deposit_rows.append({"id": i, "sold": fromCents(rng.randrange(100, 100_000)), "accountID": account_id,
+                             "userID": (account_id - 1) // accounts_per_user + 1, "created_at": past()})
+
+    drawn = sorted(
+        (past(), fromCents(rng.randrange(1, 50_000)), rng.randrange(1, account_count + 1), rng.randrange(1, account_count + 1))
+        for _ in range(transfers)
+    )
+    history = [
+        SeedTransfer(i, sold, source, target, created_at)
+        for i, (created_at, sold, source, target) in enumerate((d for d in drawn if d[2] != d[3]), start=1)
+    ]
+
+    balances = {row["id"]: row["sold"] for row in account_rows}
+    for row in deposit_rows:
+        balances[row["accountID"]] += row["sold"]
+    # Transfers the source couldn't cover stay in the history, cancelled.
+    moved = {transfer.id for transfer in applyTransfers(balances, history)}
+    transfer_rows = [
+        {"id": t.id, "sold": t.sold, "userID": (t.sourceAccountID - 1) // accounts_per_user + 1, "sourceAccountID": t.sourceAccountID,
+         "targetAccountID": t.targetAccountID, "created_at": t.created_at,
+         "status": db.TransferStatus.COMPLETED if t.id in moved else db.TransferStatus.CANCELLED}
+        for t in history
+    ]
+    for row in account_rows:
+        row["sold"] = balances[row["id"]]
+
+    ledger_rows = [entry for row in account_rows for entry in postingEntries(db.LedgerEntryKind.OPENING, OPENING_BALANCE, None, row["id"])]
+    ledger_rows += [entry for row in deposit_rows for entry in postingEntries(db.LedgerEntryKind.DEPOSIT, row["sold"], row["id"], row["accountID"])]
+    ledger_rows += [
+        entry
+        for t in history if t.id in moved
+        for entry in postingEntries(db.LedgerEntryKind.TRANSFER, t.sold, t.id, t.targetAccountID, t.sourceAccountID)
+    ]
+    activity = [change for row in deposit_rows for change in depositActivity(row["accountID"], row["created_at"].date(), row["sold"])]
+    activity += [
+        change
+        for t in history if t.id in moved
+        for change in transferMovedActivity(t.sourceAccountID, t.targetAccountID, t.created_at.date(), t.sold)
+    ]
+
+    tables = [
+        (db.User, user_rows),
+        (db.Account, account_rows),
+        (db.Beneficiary, beneficiary_rows),
+        (db.Deposit, deposit_rows),
+        (db.Transfer, transfer_rows),
+        (db.LedgerEntry, ledger_rows),
+        (db.AccountActivity, activityRows(activity)),
+    ]
+    with engine.begin() as connection:
+        for model, rows in tables:
+            _insert(connection, model, rows)
+        # New accounts must not be handed the IBANs seeded above.
+        connection.execute(insert(db.IbanSequence).values(name=SEQUENCE_NAME, nextValue=account_count + 1))
+
+    elapsed = time.perf_counter() - started
+    rows = {model.__tablename__: len(rows) for model, rows in tables}
+    return {
+        "rows": rows,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(sum(rows.values()) / elapsed, 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database", required=True, help="SQLite file to create")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--accounts-per-user", type=int, default=2)
+    parser.add_argument("--beneficiaries-per-user", type=int, default=3)
+    parser.add_argument("--transfers", type=int, default=10000)
+    parser.add_argument("--deposits", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    engine = db.build_engine(f"sqlite:///{args.database}")
+    try:
+        result = seed(engine, args.users, args.accounts_per_user, args.beneficiaries_per_user, args.transfers, args.deposits, args.seed)
+    finally:
+        engine.dispose()
+    print(json.dumps(result, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Transfers settled per second by settleTransfers, with one or more workers.
+
+    python -m benchmarks.settlement_throughput --transfers 100000 --workers 1 --workers 4
+
+Each run seeds a fresh database with due pending transfers between random
+accounts. Several workers claim batches from the same database, as separate
+processes would.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+import db
+import migrations
+from benchmarks import latencySummary
+from benchmarks.seed import seed
+from money import fromCents
+from services.settlement_service import SETTLEMENT_BATCH_SIZE, SETTLEMENT_DELAY, settleBatch
+
+def run(transfers: int, accounts: int, workers: int, batch_size: int, random_seed: int):
+    directory = tempfile.mkdtemp()
+    engine = db.build_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}")
+    try:
+        seed(engine, accounts, accounts_per_user=1, beneficiaries_per_user=0)
+        rng = random.Random(random_seed)
+        due = datetime.utcnow() - SETTLEMENT_DELAY - timedelta(seconds=1)
+        rows = []
+        for _ in range(transfers):
+            source, target = rng.sample(range(1, accounts + 1), 2)
+            rows.append({"sold": fromCents(rng.randrange(1, 10_000)), "userID": source, "sourceAccountID": source, "targetAccountID": target, "created_at": due})
+        with engine.begin() as connection:
+            connection.execute(insert(db.Transfer), rows)
+            # Inserted behind the API's back, so reserve their amounts the way the migration does.
+            migrations.reserve_pending_transfers(connection)
+
+        batches = []
+
+        def worker(name: str):
+            now = datetime.utcnow()
+            with Session(engine) as session:
+                while True:
+                    started = time.perf_counter()
+                    count = settleBatch(session, now - SETTLEMENT_DELAY, batch_size, name, now).claimed
+                    if count:
+                        batches.append(time.perf_counter() - started)
+                    if count < batch_size:
+                        return
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(worker, [f"bench-{i}" for i in range(workers)]))
+        elapsed = time.perf_counter() - started
+    finally:
+        engine.dispose()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        "transfers": transfers,
+        "accounts": accounts,
+        "workers": workers,
+        "batch_size": batch_size,
+        "batches": len(batches),
+        "seconds": round(elapsed, 3),
+        "transfers_per_second": round(transfers / elapsed, 1),
+        "batch_latency_ms": latencySummary(batches),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--transfers", type=int, default=100000)
+    parser.add_argument("--accounts", type=int, default=1000)
+    parser.add_argument("--workers", type=int, action="append", help="settlement workers, can be repeated to compare")
+    parser.add_argument("--batch-size", type=int, default=SETTLEMENT_BATCH_SIZE)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    results = [run(args.transfers, args.accounts, workers, args.batch_size, args.seed) for workers in args.workers or [1]]
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Write throughput of the sync engine with and without the SQLite tuning.
+
+    python -m benchmarks.write_throughput --threads 8 --writes 500
+
+Each thread posts deposits on its own account, one commit per write, which is
+the shape of the deposit route racing the settlement loop.
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from sqlmodel import SQLModel, Session
+import db
+
+def run(tune_sqlite: bool, threads: int, writes: int):
+    directory = tempfile.mkdtemp()
+    engine = db.build_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}", tune_sqlite=tune_sqlite)
+    SQLModel.metadata.create_all(engine)
+
+    with Session(engine) as session:
+        user = db.User(name="bench", email="bench@example.com", password="x")
+        session.add(user)
+        session.commit()
+        accounts = [db.Account(name=f"bench{i}", userID=user.id, iban=f"{i:034d}") for i in range(threads)]
+        session.add_all(accounts)
+        session.commit()
+        targets = [(user.id, account.id) for account in accounts]
+
+    errors = []
+
+    def writer(user_id: int, account_id: int):
+        with Session(engine) as session:
+            for _ in range(writes):
+                try:
+                    session.add(db.Deposit(sold=1, userID=user_id, accountID=account_id))
+                    account = session.get(db.Account, account_id)
+                    account.sold += 1
+                    session.commit()
+                except Exception as error:
+                    session.rollback()
+                    errors.append(type(error).__name__)
+
+    workers = [threading.Thread(target=writer, args=target) for target in targets]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    engine.dispose()
+    shutil.rmtree(directory, ignore_errors=True)
+
+    committed = threads * writes - len(errors)
+    return {
+        "tuned": tune_sqlite,
+        "threads": threads,
+        "writes": threads * writes,
+        "errors": len(errors),
+        "seconds": round(elapsed, 3),
+        "writes_per_second": round(committed / elapsed, 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--writes", type=int, default=500, help="writes per thread")
+    args = parser.parse_args()
+
+    results = [run(False, args.threads, args.writes), run(True, args.threads, args.writes)]
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,33 @@
-from os import system
-from sqlmodel import Field, SQLModel, create_engine, Session, update
-from datetime import datetime
+from sqlmodel import Field, SQLModel, create_engine, Session
+from sqlalchemy import BigInteger, Index, event, insert_sentinel
+from sqlalchemy.engine import make_url, URL
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from starlette.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
+from datetime import date, datetime
+from decimal import Decimal
 from enum import Enum
+from dotenv import load_dotenv
+import os
+from money import MoneyType
+
+load_dotenv()
+
+# Routes talk to the database through an AsyncSession over aiosqlite. Set USE_ASYNC_DB=0
+# to run them on the blocking driver instead, offloaded to the threadpool call by call.
+USE_ASYNC_DB = os.getenv("USE_ASYNC_DB", "1") == "1"
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///database.db")
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "-1"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg", "mysql": "mysql+aiomysql"}
 
 class User(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
@@ -10,8 +36,12 @@ class User(SQLModel, table=True):
     password: str = Field(max_length=255)
 
 class Account(SQLModel, table=True):
+    __table_args__ = (Index("ix_account_userID_name", "userID", "name"),)
+
     id: int | None = Field(default=None, primary_key=True)
-    sold: float = Field(default=0)
+    sold: Decimal = Field(default=0, sa_type=MoneyType)
+    # What the account's pending transfers will take; new transfers may only spend sold - reserved.
+    reserved: Decimal = Field(default=0, sa_type=MoneyType, sa_column_kwargs={"server_default": "0"})
     userID: int = Field(foreign_key="user.id")
     iban: str = Field(max_length=34, unique=True, index=True)
     name: str = Field(index=True)
@@ -20,8 +50,10 @@ class Account(SQLModel, table=True):
     isClosed: bool = Field(default=False)   
 
 class Deposit(SQLModel, table=True):
+    __table_args__ = (Index("ix_deposit_accountID_created_at", "accountID", "created_at"),)
+
     id: int | None = Field(default=None, primary_key=True)
-    sold: float
+    sold: Decimal = Field(sa_type=MoneyType)
     userID: int = Field(foreign_key="user.id")
     accountID: int = Field(foreign_key="account.id")
     created_at: datetime = Field(default_factory=datetime.utcnow)
@@ -32,13 +64,56 @@ class TransferStatus(Enum):
     CANCELLED = "cancelled"
 
 class Transfer(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_transfer_status_created_at", "status", "created_at"),
+        Index("ix_transfer_sourceAccountID_status", "sourceAccountID", "status"),
+        Index("ix_transfer_targetAccountID_status", "targetAccountID", "status"),
+        Index("ix_transfer_sourceAccountID_created_at", "sourceAccountID", "created_at"),
+        Index("ix_transfer_targetAccountID_created_at", "targetAccountID", "created_at"),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
-    sold: float
+    sold: Decimal = Field(sa_type=MoneyType)
     userID: int = Field(foreign_key="user.id")
     sourceAccountID: int = Field(foreign_key="account.id")
     targetAccountID: int = Field(foreign_key="account.id")
     created_at: datetime = Field(default_factory=datetime.utcnow)
     status: TransferStatus = Field(default=TransferStatus.PENDING)
+    # Settlement lease: the worker settling this transfer, until claimExpiresAt.
+    claimedBy: str | None = Field(default=None, max_length=64)
+    claimExpiresAt: datetime | None = None
+    # Position of the row in a multi-row INSERT, so RETURNING can hand the ids back in submission order.
+    batchSentinel: int | None = Field(default=None, sa_column=insert_sentinel("batchSentinel"))
+
+# Finished transfers and old deposits are moved here by services/archive_service.py,
+# keeping their ids, so the live tables only hold recent and pending rows.
+class TransferArchive(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_transferarchive_sourceAccountID_created_at", "sourceAccountID", "created_at"),
+        Index("ix_transferarchive_targetAccountID_created_at", "targetAccountID", "created_at"),
+    )
+
+    id: int = Field(primary_key=True)
+    sold: Decimal = Field(sa_type=MoneyType)
+    userID: int = Field(foreign_key="user.id")
+    sourceAccountID: int = Field(foreign_key="account.id")
+    targetAccountID: int = Field(foreign_key="account.id")
+    created_at: datetime
+    status: TransferStatus
+
+class DepositArchive(SQLModel, table=True):
+    __table_args__ = (Index("ix_depositarchive_accountID_created_at", "accountID", "created_at"),)
+
+    id: int = Field(primary_key=True)
+    sold: Decimal = Field(sa_type=MoneyType)
+    userID: int = Field(foreign_key="user.id")
+    accountID: int = Field(foreign_key="account.id")
+    created_at: datetime
+
+class ArchiveMark(SQLModel, table=True):
+    """Newest created_at moved to the archive from the live table name; history starting after it never reads the archive."""
+    name: str = Field(primary_key=True, max_length=64)
+    newest: datetime | None = Field(default=None)
 
 class Beneficiary(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
@@ -47,7 +122,170 @@ class Beneficiary(SQLModel, table=True):
     userID: int = Field(foreign_key="user.id")
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
-engine = create_engine("sqlite:///database.db", connect_args={"check_same_thread": False})
+class LedgerEntryKind(Enum):
+    OPENING = "opening"
+    DEPOSIT = "deposit"
+    TRANSFER = "transfer"
+
+# Every balance change posts legs that sum to zero. A leg without accountID is the
+# outside world, money coming in through a deposit or an account opening.
+class LedgerEntry(SQLModel, table=True):
+    __table_args__ = (Index("ix_ledgerentry_accountID_id", "accountID", "id"),)
+
+    id: int | None = Field(default=None, primary_key=True)
+    accountID: int | None = Field(default=None, foreign_key="account.id")
+    amount: Decimal = Field(sa_type=MoneyType)
+    kind: LedgerEntryKind
+    referenceID: int | None = Field(default=None)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+class BalanceSnapshot(SQLModel, table=True):
+    __table_args__ = (Index("ix_balancesnapshot_accountID_id", "accountID", "id"),)
+
+    id: int | None = Field(default=None, primary_key=True)
+    accountID: int = Field(foreign_key="account.id")
+    balance: Decimal = Field(sa_type=MoneyType)
+    lastEntryID: int
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
+class AccountActivity(SQLModel, table=True):
+    """Per account and day totals, kept up to date as money moves (see services/activity_service.py).
+
+    Settled transfers count on the day they settled; pending ones on the day
+    they were created, until they settle or are cancelled.
+    """
+    accountID: int = Field(foreign_key="account.id", primary_key=True)
+    day: date = Field(primary_key=True)
+    deposits: int = Field(default=0)
+    depositTotal: Decimal = Field(default=0, sa_type=MoneyType)
+    transfersIn: int = Field(default=0)
+    inflow: Decimal = Field(default=0, sa_type=MoneyType)
+    transfersOut: int = Field(default=0)
+    outflow: Decimal = Field(default=0, sa_type=MoneyType)
+    pending: int = Field(default=0)
+    pendingOut: Decimal = Field(default=0, sa_type=MoneyType)
+
+class IdempotencyKey(SQLModel, table=True):
+    """A key belongs to the user who sent it; fingerprint hashes the request body it was first used with."""
+    userID: int = Field(primary_key=True)
+    key: str = Field(primary_key=True, max_length=255)
+    route: str = Field(max_length=255)
+    fingerprint: str | None = Field(default=None, max_length=64)
+    response: str | None = Field(default=None)
+    created_at: datetime = Field(default_factory=datetime.utcnow, index=True)
+
+class IbanSequence(SQLModel, table=True):
+    """Next account number to hand out; workers reserve blocks of it (see iban.py)."""
+    name: str = Field(primary_key=True, max_length=64)
+    nextValue: int = Field(sa_type=BigInteger)
+
+class SchemaMigration(SQLModel, table=True):
+    name: str = Field(primary_key=True, max_length=255)
+    applied_at: datetime = Field(default_factory=datetime.utcnow)
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.close()
+
+def engine_options(url: URL, poolclass):
+    options = {"pool_pre_ping": DB_POOL_PRE_PING, "pool_recycle": DB_POOL_RECYCLE}
+    if url.get_backend_name() == "sqlite":
+        options["connect_args"] = {"check_same_thread": False}
+        # In-memory databases live on a single connection, there is no pool to size.
+        if url.database in (None, "", ":memory:"):
+            return options
+    options["poolclass"] = poolclass
+    options["pool_size"] = DB_POOL_SIZE
+    options["max_overflow"] = DB_MAX_OVERFLOW
+    return options
+
+def async_url(url: URL):
+    if ASYNC_DATABASE_URL:
+        return make_url(ASYNC_DATABASE_URL)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+
+def build_engine(url: str = DATABASE_URL, tune_sqlite: bool = True):
+    url = make_url(url)
+    built = create_engine(url, **engine_options(url, QueuePool))
+    if tune_sqlite and url.get_backend_name() == "sqlite":
+        event.listen(built, "connect", set_sqlite_pragmas)
+    return built
+
+def build_async_engine(url: str = DATABASE_URL, tune_sqlite: bool = True):
+    url = async_url(make_url(url))
+    built = create_async_engine(url, **engine_options(url, AsyncAdaptedQueuePool))
+    if tune_sqlite and url.get_backend_name() == "sqlite":
+        event.listen(built.sync_engine, "connect", set_sqlite_pragmas)
+    return built
+
+engine = build_engine()
+async_engine = build_async_engine()
+async_session_factory = async_sessionmaker(async_engine, expire_on_commit=False)
+
+class ThreadedSession:
+    """Blocking Session behind the AsyncSession API, used when USE_ASYNC_DB is off."""
+
+    def __init__(self, sync_session: Session):
+        self.sync_session = sync_session
+
+    def add(self, instance):
+        self.sync_session.add(instance)
+
+    def add_all(self, instances):
+        self.sync_session.add_all(instances)
+
+    async def execute(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.execute, *args, **kwargs)
+
+    async def scalars(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.scalars, *args, **kwargs)
+
+    async def scalar(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.scalar, *args, **kwargs)
+
+    async def get(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.get, *args, **kwargs)
+
+    async def flush(self):
+        await run_in_threadpool(self.sync_session.flush)
+
+    async def commit(self):
+        await run_in_threadpool(self.sync_session.commit)
+
+    async def rollback(self):
+        await run_in_threadpool(self.sync_session.rollback)
+
+    async def refresh(self, instance):
+        await run_in_threadpool(self.sync_session.refresh, instance)
+
+    async def stream(self, statement, **kwargs):
+        result = await run_in_threadpool(self.sync_session.execute, statement.execution_options(stream_results=True), **kwargs)
+        return ThreadedResult(result)
+
+    async def run_sync(self, fn, *args, **kwargs):
+        return await run_in_threadpool(fn, self.sync_session, *args, **kwargs)
+
+    async def close(self):
+        await run_in_threadpool(self.sync_session.close)
+
+class ThreadedResult:
+    """Server-side cursor read in chunks on the threadpool, iterated with async for."""
+
+    def __init__(self, result, chunk_size: int = 500):
+        self.result = result
+        self.chunk_size = chunk_size
+
+    async def __aiter__(self):
+        while True:
+            rows = await run_in_threadpool(self.result.fetchmany, self.chunk_size)
+            if not rows:
+                return
+            for row in rows:
+                yield row
 
 def create_session():
     return Session(engine)
@@ -61,3 +299,20 @@ def get_db():
         yield session
     finally:
         session.close()
+
+@asynccontextmanager
+async def open_async_session():
+    if USE_ASYNC_DB:
+        async with async_session_factory() as session:
+            yield session
+        return
+
+    session = ThreadedSession(Session(engine, expire_on_commit=False))
+    try:
+        yield session
+    finally:
+        await session.close()
+
+async def get_async_db():
+    async with open_async_session() as session:
+        yield session
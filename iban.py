@@ -0,0 +1,100 @@
+"""French-format IBANs numbered from a database sequence.
+
+Each process reserves a block of account numbers with one UPDATE and hands them
+out from memory, so allocating an IBAN needs no lookup and two processes can
+never produce the same one.
+"""
+import os
+import threading
+from sqlalchemy import insert, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
+import db
+
+IBAN_COUNTRY = "FR"
+IBAN_BANK_CODE = os.getenv("IBAN_BANK_CODE", "12345")
+IBAN_BRANCH_CODE = os.getenv("IBAN_BRANCH_CODE", "00001")
+IBAN_BLOCK_SIZE = int(os.getenv("IBAN_BLOCK_SIZE", "1000"))
+ACCOUNT_NUMBER_DIGITS = 11
+SEQUENCE_NAME = "account_number"
+
+def ribKey(bank: str, branch: str, account: str):
+    return f"{97 - (89 * int(bank) + 15 * int(branch) + 3 * int(account)) % 97:02d}"
+
+def _mod97(text: str):
+    # Letters count as 10 to 35, as in ISO 13616.
+    return int("".join(str(int(char, 36)) for char in text)) % 97
+
+def checkDigits(country: str, bban: str):
+    return f"{98 - _mod97(bban + country + '00'):02d}"
+
+def isValidIban(iban: str):
+    return len(iban) <= 34 and iban[:2].isalpha() and iban.isalnum() and _mod97(iban[4:] + iban[:4]) == 1
+
+def formatIban(account_number: int, bank: str = IBAN_BANK_CODE, branch: str = IBAN_BRANCH_CODE):
+    account = f"{account_number:0{ACCOUNT_NUMBER_DIGITS}d}"
+    bban = f"{bank}{branch}{account}{ribKey(bank, branch, account)}"
+    return f"{IBAN_COUNTRY}{checkDigits(IBAN_COUNTRY, bban)}{bban}"
+
+class IbanAllocator:
+    def __init__(self, engine: Engine, block_size: int = IBAN_BLOCK_SIZE):
+        self.engine = engine
+        self.block_size = block_size
+        self._next = 0
+        self._end = 0
+        self._lock = threading.Lock()
+
+    def _reserve(self, count: int):
+        """Takes count account numbers from the shared sequence in its own transaction; returns the first one."""
+        sequence = db.IbanSequence
+        while True:
+            with self.engine.begin() as connection:
+                reserved = connection.scalar(
+                    update(sequence)
+                    .where(sequence.name == SEQUENCE_NAME)
+                    .values(nextValue=sequence.nextValue + count)
+                    .returning(sequence.nextValue)
+                )
+                if reserved is not None:
+                    return reserved - count
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(insert(sequence).values(name=SEQUENCE_NAME, nextValue=1))
+            except IntegrityError:
+                # Another process created the sequence first.
+                pass
+
+    def _take(self, count: int):
+        if self._end - self._next < count:
+            return None
+        first = self._next
+        self._next += count
+        return [formatIban(number) for number in range(first, first + count)]
+
+    def allocateMany(self, count: int):
+        """count new IBANs, reserving more account numbers from the database if the current block runs out."""
+        with self._lock:
+            ibans = self._take(count)
+            if ibans is None:
+                # Whatever is left of the current block is dropped: gaps are fine, reuse is not.
+                self._next = self._reserve(count + self.block_size)
+                self._end = self._next + count + self.block_size
+                ibans = self._take(count)
+            return ibans
+
+    def allocate(self):
+        return self.allocateMany(1)[0]
+
+    async def allocateManyAsync(self, count: int):
+        """Like allocateMany, but a reservation that has to reach the database runs off the event loop."""
+        with self._lock:
+            ibans = self._take(count)
+        if ibans is None:
+            ibans = await run_in_threadpool(self.allocateMany, count)
+        return ibans
+
+    async def allocateAsync(self):
+        return (await self.allocateManyAsync(1))[0]
+
+iban_allocator = IbanAllocator(db.engine)
@@ -0,0 +1,109 @@
+"""Request and SQL instrumentation feeding the metrics registry.
+
+MetricsMiddleware times every request by route and status. The engine hooks
+count and time each SQL statement, globally and against the request that ran
+it, so a route issuing one query per row shows up in http_request_queries.
+
+Routes declare how many statements a request may run with @queryBudget; going
+over is counted, and raises when ENFORCE_QUERY_BUDGETS is on (as in the tests).
+"""
+from contextvars import ContextVar
+import os
+import time
+from sqlalchemy import event
+from metrics import Counter, Gauge, Histogram
+
+QUERY_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 250)
+ENFORCE_QUERY_BUDGETS = os.getenv("ENFORCE_QUERY_BUDGETS", "0") == "1"
+
+http_requests = Counter("http_requests_total", "Requests by route and status code", ["method", "route", "status"])
+http_request_seconds = Histogram("http_request_duration_seconds", "Request latency by route", ["method", "route"])
+http_in_flight = Gauge("http_requests_in_flight", "Requests being handled")
+request_queries = Histogram("http_request_queries", "SQL statements executed per request", ["route"], buckets=QUERY_BUCKETS)
+request_query_seconds = Histogram("http_request_query_seconds", "Time spent in SQL per request", ["route"])
+db_queries = Counter("db_queries_total", "SQL statements executed")
+db_query_seconds = Histogram("db_query_duration_seconds", "SQL statement latency")
+query_budget_exceeded = Counter("http_query_budget_exceeded_total", "Requests that ran more SQL statements than their route's budget", ["route"])
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+def queryBudget(limit: int):
+    """Declares the most SQL statements one request to the decorated route may run."""
+    def decorate(endpoint):
+        endpoint.query_budget = limit
+        return endpoint
+    return decorate
+
+class QueryStats:
+    __slots__ = ("count", "seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+current_queries: ContextVar[QueryStats | None] = ContextVar("current_queries", default=None)
+
+def _beforeExecute(conn, cursor, statement, parameters, context, executemany):
+    context._query_started = time.perf_counter()
+
+def _afterExecute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._query_started
+    db_queries.inc()
+    db_query_seconds.observe(elapsed)
+    stats = current_queries.get()
+    if stats is not None:
+        stats.count += 1
+        stats.seconds += elapsed
+
+def instrumentEngine(engine):
+    """Counts the statements of a sync engine (for an AsyncEngine, pass its sync_engine)."""
+    if not event.contains(engine, "after_cursor_execute", _afterExecute):
+        event.listen(engine, "before_cursor_execute", _beforeExecute)
+        event.listen(engine, "after_cursor_execute", _afterExecute)
+
+def routeName(scope):
+    # The route template, not the raw path, so /users/1 and /users/2 share their series.
+    route = scope.get("route")
+    return route.path if route is not None else "unmatched"
+
+def queryBudgetOf(scope):
+    return getattr(getattr(scope.get("route"), "endpoint", None), "query_budget", None)
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def sendWithStatus(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        stats = QueryStats()
+        token = current_queries.set(stats)
+        http_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, sendWithStatus)
+        finally:
+            elapsed = time.perf_counter() - started
+            http_in_flight.dec()
+            current_queries.reset(token)
+            route = routeName(scope)
+            http_requests.inc(method=scope["method"], route=route, status=status)
+            http_request_seconds.observe(elapsed, method=scope["method"], route=route)
+            request_queries.observe(stats.count, route=route)
+            request_query_seconds.observe(stats.seconds, route=route)
+
+        budget = queryBudgetOf(scope)
+        if budget is not None and stats.count > budget:
+            query_budget_exceeded.inc(route=route)
+            if ENFORCE_QUERY_BUDGETS:
+                raise QueryBudgetExceeded(f"{scope['method']} {route} ran {stats.count} SQL statements, its budget is {budget}")
@@ -1,8 +1,15 @@
 import db
+import migrations
 from fastapi import FastAPI
 from fastapi_utilities import repeat_every
-from datetime import datetime, timedelta
-from routes import auth_router, accounts_router, transfer_router, beneficiaries_router
+from instrumentation import MetricsMiddleware, instrumentEngine
+from metrics import METRICS_ENABLED
+from routes import auth_router, accounts_router, transfer_router, beneficiaries_router, metrics_router, events_router
+from services.archive_service import archiveHistory
+from services.iban_directory import IBAN_DIRECTORY_REFRESH_SECONDS, iban_directory
+from services.idempotency_service import purgeIdempotencyKeys
+from services.ledger_service import takeSnapshots
+from services.settlement_scheduler import settlement_scheduler
 
 app = FastAPI()
 
@@ -10,37 +17,50 @@ app.include_router(auth_router)
 app.include_router(accounts_router)
 app.include_router(transfer_router)
 app.include_router(beneficiaries_router)
+app.include_router(events_router)
+
+if METRICS_ENABLED:
+    app.include_router(metrics_router)
+    app.add_middleware(MetricsMiddleware)
+    instrumentEngine(db.engine)
+    instrumentEngine(db.async_engine.sync_engine)
 
 db.create_db_and_tables()
+migrations.migrate(db.engine)
+for index in migrations.check_indexes(db.engine):
+    print(f"Missing index {index}, queries on this table will scan it")
 
 @app.on_event("startup")
-@repeat_every(seconds=5)
 def processTransfers():
-    print("Processing transfers...")
-    db_session = next(db.get_db())
-    
-    min_timestamp = datetime.utcnow() - timedelta(seconds=10)
-
-    completedTransfer_query = (
-        db_session.query(db.Transfer)
-        .filter(
-            db.Transfer.status == db.TransferStatus.PENDING,
-            db.Transfer.created_at <= min_timestamp  
-        )
-    )
-    transfers = db_session.scalars(completedTransfer_query).all()
-
-    for transfer in transfers:
-        sourceAccount = db_session.query(db.Account).filter(db.Account.id == transfer.sourceAccountID).first()
-        targetAccount = db_session.query(db.Account).filter(db.Account.id == transfer.targetAccountID).first()
-
-        if sourceAccount and targetAccount and sourceAccount.sold >= transfer.sold:
-            sourceAccount.sold -= transfer.sold
-            targetAccount.sold += transfer.sold
-            db_session.add(sourceAccount)
-            db_session.add(targetAccount)
-            db_session.commit()
-
-        transfer.status = db.TransferStatus.COMPLETED
-        db_session.add(transfer)
-        db_session.commit()
+    settlement_scheduler.start()
+
+@app.on_event("shutdown")
+def stopProcessingTransfers():
+    settlement_scheduler.stop()
+
+@app.on_event("startup")
+@repeat_every(seconds=IBAN_DIRECTORY_REFRESH_SECONDS)
+def loadIbanDirectory():
+    # Also picks up accounts other processes closed since the last load.
+    with db.create_session() as db_session:
+        iban_directory.load(db_session)
+
+@app.on_event("startup")
+@repeat_every(seconds=3600)
+def snapshotBalances():
+    with db.create_session() as db_session:
+        takeSnapshots(db_session)
+
+@app.on_event("startup")
+@repeat_every(seconds=86400)
+def archiveOldHistory():
+    with db.create_session() as db_session:
+        result = archiveHistory(db_session)
+    if result.transfers or result.deposits:
+        print(f"Archived {result.transfers} transfers and {result.deposits} deposits in {result.duration:.1f} s")
+
+@app.on_event("startup")
+@repeat_every(seconds=3600)
+def purgeExpiredIdempotencyKeys():
+    with db.create_session() as db_session:
+        purgeIdempotencyKeys(db_session)
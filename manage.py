@@ -0,0 +1,57 @@
+"""Maintenance commands.
+
+    python manage.py migrate
+    python manage.py ledger-verify
+    python manage.py ledger-snapshot
+    python manage.py archive
+"""
+import argparse
+import sys
+import db
+import migrations
+from services.archive_service import archiveHistory
+from services.ledger_service import takeSnapshots, verifyBalances
+
+def migrate(args):
+    db.create_db_and_tables()
+    migrations.migrate(db.engine)
+    missing = migrations.check_indexes(db.engine)
+    for index in missing:
+        print(f"Missing index {index}")
+    return 1 if missing else 0
+
+def ledger_verify(args):
+    with db.create_session() as session:
+        mismatches = verifyBalances(session)
+    for account_id, sold, balance in mismatches:
+        print(f"Account {account_id}: sold {sold}, ledger {balance}")
+    print(f"{len(mismatches)} account(s) out of balance")
+    return 1 if mismatches else 0
+
+def ledger_snapshot(args):
+    with db.create_session() as session:
+        count = takeSnapshots(session)
+    print(f"{count} snapshot(s) taken")
+    return 0
+
+def archive(args):
+    with db.create_session() as session:
+        result = archiveHistory(session)
+    print(f"{result.transfers} transfer(s) and {result.deposits} deposit(s) archived in {result.duration:.1f} s")
+    return 0
+
+COMMANDS = {
+    "migrate": migrate,
+    "ledger-verify": ledger_verify,
+    "ledger-snapshot": ledger_snapshot,
+    "archive": archive,
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="BankGobelin maintenance commands")
+    parser.add_argument("command", choices=COMMANDS)
+    args = parser.parse_args(argv)
+    return COMMANDS[args.command](args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,210 @@
+"""Schema changes for databases created before the current models.
+
+create_all only creates missing tables, so anything added to an existing table
+(indexes, columns, type changes) is applied here, once, and recorded in the
+schemamigration table.
+"""
+from datetime import date
+from sqlalchemy import Integer, func, inspect, insert, select, type_coerce, update
+from sqlalchemy.schema import CreateColumn, CreateTable
+from sqlalchemy.engine import Connection, Engine
+from sqlmodel import SQLModel
+import db
+from money import MINOR_UNITS, MoneyType
+from services.activity_service import activityRows, activityUpsert
+from services.ledger_service import postingEntries
+
+def missing_indexes(connection: Connection):
+    inspector = inspect(connection)
+    existing_tables = set(inspector.get_table_names())
+    missing = []
+    for table in SQLModel.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        missing += [index for index in table.indexes if index.name not in existing]
+    return missing
+
+def add_query_indexes(connection: Connection):
+    for index in missing_indexes(connection):
+        index.create(connection)
+
+def add_missing_columns(connection: Connection):
+    """Adds the declared columns an existing table doesn't have yet; they must be nullable or have a server default."""
+    inspector = inspect(connection)
+    existing_tables = set(inspector.get_table_names())
+    for table in SQLModel.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                definition = CreateColumn(column).compile(dialect=connection.dialect)
+                connection.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN {definition}')
+
+MONEY_COLUMNS = {
+    "account": ["sold"],
+    "deposit": ["sold"],
+    "transfer": ["sold"],
+    "ledgerentry": ["amount"],
+    "balancesnapshot": ["balance"],
+}
+
+def rebuild_sqlite_table(connection: Connection, table, expressions: dict):
+    """SQLite can't change a column type in place: copy the rows into a table with the current definition."""
+    scratch = f"new_{table.name}"
+    create = str(CreateTable(table).compile(dialect=connection.dialect)).replace(f"CREATE TABLE {table.name} ", f"CREATE TABLE {scratch} ", 1)
+    connection.exec_driver_sql(create)
+    # Columns added by later migrations don't exist yet and keep their defaults, unless expressions fills them.
+    existing = [column["name"] for column in inspect(connection).get_columns(table.name)]
+    copied = [column.name for column in table.columns if column.name in existing or column.name in expressions]
+    columns = ", ".join(f'"{name}"' for name in copied)
+    values = ", ".join(expressions.get(name, f'"{name}"') for name in copied)
+    connection.exec_driver_sql(f'INSERT INTO {scratch} ({columns}) SELECT {values} FROM "{table.name}"')
+    connection.exec_driver_sql(f'DROP TABLE "{table.name}"')
+    connection.exec_driver_sql(f'ALTER TABLE {scratch} RENAME TO "{table.name}"')
+    for index in table.indexes:
+        index.create(connection)
+
+def money_to_cents(connection: Connection):
+    """Amounts were stored as floats, they are now integer cents."""
+    inspector = inspect(connection)
+    for table_name, money_columns in MONEY_COLUMNS.items():
+        if not inspector.has_table(table_name):
+            continue
+        types = {column["name"]: column["type"] for column in inspector.get_columns(table_name)}
+        # Tables created after the change already hold cents.
+        to_convert = [name for name in money_columns if not isinstance(types[name], Integer)]
+        if not to_convert:
+            continue
+        expressions = {name: f'CAST(ROUND("{name}" * {MINOR_UNITS}) AS INTEGER)' for name in to_convert}
+        table = SQLModel.metadata.tables[table_name]
+        if connection.dialect.name == "sqlite":
+            rebuild_sqlite_table(connection, table, expressions)
+        else:
+            for name, expression in expressions.items():
+                connection.exec_driver_sql(f'ALTER TABLE "{table_name}" ALTER COLUMN "{name}" TYPE BIGINT USING {expression}')
+
+def backfill_ledger(connection: Connection):
+    """Opening entries for balances that predate the ledger."""
+    # Balances are read and posted as cents, convert them first if this database still holds floats.
+    money_to_cents(connection)
+    has_entries = select(db.LedgerEntry.id).where(db.LedgerEntry.accountID == db.Account.id).exists()
+    accounts = connection.execute(select(db.Account.id, db.Account.sold).where(db.Account.sold != 0, ~has_entries)).all()
+    entries = [entry for account in accounts for entry in postingEntries(db.LedgerEntryKind.OPENING, account.sold, None, account.id)]
+    if entries:
+        connection.execute(insert(db.LedgerEntry), entries)
+
+def transfer_leg(model):
+    return select(db.LedgerEntry.id).where(db.LedgerEntry.kind == db.LedgerEntryKind.TRANSFER, db.LedgerEntry.referenceID == model.id).exists()
+
+def upsert_activity_totals(connection: Connection, totals):
+    """Adds (model, account column, conditions, count counter, total counter) sums, per account and creation day, to accountactivity."""
+    changes = []
+    for model, account_column, conditions, count_name, total_name in totals:
+        day = func.date(model.created_at)
+        query = (
+            select(account_column, day, func.count(), type_coerce(func.sum(model.sold), MoneyType))
+            .where(*conditions)
+            .group_by(account_column, day)
+        )
+        for account_id, day_value, count, total in connection.execute(query):
+            # SQLite hands date() back as text.
+            day_value = day_value if isinstance(day_value, date) else date.fromisoformat(day_value)
+            changes.append((account_id, day_value, {count_name: count, total_name: total}))
+    rows = activityRows(changes)
+    if rows:
+        connection.execute(activityUpsert(), rows)
+
+def backfill_account_activity(connection: Connection):
+    """Daily totals for the history recorded before AccountActivity; past settlements count on the day the transfer was created."""
+    completed = [db.Transfer.status == db.TransferStatus.COMPLETED, transfer_leg(db.Transfer)]
+    pending = [db.Transfer.status == db.TransferStatus.PENDING]
+    upsert_activity_totals(connection, [
+        (db.Deposit, db.Deposit.accountID, [], "deposits", "depositTotal"),
+        (db.Transfer, db.Transfer.sourceAccountID, completed, "transfersOut", "outflow"),
+        (db.Transfer, db.Transfer.targetAccountID, completed, "transfersIn", "inflow"),
+        (db.Transfer, db.Transfer.sourceAccountID, pending, "pending", "pendingOut"),
+    ])
+
+def backfill_pre_ledger_transfers(connection: Connection):
+    """Counts the completed transfers settled before the ledger existed, which 0006 left out for lack of a ledger leg.
+
+    Before the ledger, settlement marked a transfer completed even when the
+    source couldn't cover it and nothing moved; the two cases left the same
+    rows, so every completed transfer created before the first ledger entry
+    counts as moved, as the transaction log shows it. Later ones without a leg
+    really were skipped. Archived transfers are included.
+    """
+    ledger_started = connection.scalar(select(func.min(db.LedgerEntry.created_at)))
+    totals = []
+    for model in (db.Transfer, db.TransferArchive):
+        conditions = [model.status == db.TransferStatus.COMPLETED, ~transfer_leg(model)]
+        if ledger_started is not None:
+            conditions.append(model.created_at < ledger_started)
+        totals += [
+            (model, model.sourceAccountID, conditions, "transfersOut", "outflow"),
+            (model, model.targetAccountID, conditions, "transfersIn", "inflow"),
+        ]
+    upsert_activity_totals(connection, totals)
+
+def reserve_pending_transfers(connection: Connection):
+    """Adds account.reserved and reserves what each account's pending transfers will take."""
+    add_missing_columns(connection)
+    pending = (
+        select(func.coalesce(func.sum(db.Transfer.sold), 0))
+        .where(db.Transfer.sourceAccountID == db.Account.id, db.Transfer.status == db.TransferStatus.PENDING)
+        .scalar_subquery()
+    )
+    connection.execute(update(db.Account).values(reserved=pending))
+
+def scope_idempotency_keys(connection: Connection):
+    """Keys become (userID, key) with a request fingerprint.
+
+    Keys recorded before don't say whose they were: they are kept under userID 0
+    with no fingerprint, so they answer no retry and expire with IDEMPOTENCY_KEY_TTL_HOURS.
+    """
+    # Tables created since already have the current definition.
+    if "userID" in {column["name"] for column in inspect(connection).get_columns("idempotencykey")}:
+        return
+    if connection.dialect.name == "sqlite":
+        rebuild_sqlite_table(connection, db.IdempotencyKey.__table__, {"userID": "0"})
+        return
+    connection.exec_driver_sql('ALTER TABLE idempotencykey ADD COLUMN "userID" INTEGER NOT NULL DEFAULT 0, ADD COLUMN fingerprint VARCHAR(64)')
+    connection.exec_driver_sql('ALTER TABLE idempotencykey ALTER COLUMN "userID" DROP DEFAULT')
+    connection.exec_driver_sql('ALTER TABLE idempotencykey DROP CONSTRAINT idempotencykey_pkey, ADD PRIMARY KEY ("userID", key)')
+
+def record_archive_marks(connection: Connection):
+    """The newest row each live table has already archived, which history reads now compare against."""
+    for live, archive in ((db.Transfer, db.TransferArchive), (db.Deposit, db.DepositArchive)):
+        if connection.scalar(select(db.ArchiveMark.name).where(db.ArchiveMark.name == live.__tablename__)) is None:
+            newest = connection.scalar(select(func.max(archive.created_at)))
+            connection.execute(insert(db.ArchiveMark).values(name=live.__tablename__, newest=newest))
+
+MIGRATIONS = [
+    ("0001_query_indexes", add_query_indexes),
+    ("0002_transaction_log_indexes", add_query_indexes),
+    ("0003_ledger_opening_entries", backfill_ledger),
+    ("0004_money_in_cents", money_to_cents),
+    ("0005_transfer_claims", add_missing_columns),
+    ("0006_account_activity", backfill_account_activity),
+    ("0007_account_reservations", reserve_pending_transfers),
+    ("0008_idempotency_key_scope", scope_idempotency_keys),
+    ("0009_pre_ledger_transfer_activity", backfill_pre_ledger_transfers),
+    ("0010_archive_marks", record_archive_marks),
+    ("0011_transfer_batch_sentinel", add_missing_columns),
+]
+
+def migrate(engine: Engine):
+    with engine.begin() as connection:
+        applied = set(connection.scalars(select(db.SchemaMigration.name)))
+        for name, migration in MIGRATIONS:
+            if name in applied:
+                continue
+            migration(connection)
+            connection.execute(insert(db.SchemaMigration).values(name=name))
+
+def check_indexes(engine: Engine):
+    """Names of the declared indexes the database doesn't have."""
+    with engine.connect() as connection:
+        return [f"{index.table.name}.{index.name}" for index in missing_indexes(connection)]
@@ -1,6 +1,8 @@
 # TODO: Inheritance to avoid repetitions
-from pydantic import BaseModel, EmailStr, constr
-from datetime import datetime, timezone
+from pydantic import BaseModel, EmailStr, conint, conlist, constr
+from datetime import date, datetime, timezone
+from typing import Literal
+from money import Money
 
 class UserBase(BaseModel):
     name : str
@@ -18,8 +20,8 @@ class UserLogin(BaseModel):
         
 class AccountBase(BaseModel):
     name: str
-    sold: float
-    iban: constr(min_length=34, max_length=34)
+    sold: Money
+    iban: constr(min_length=15, max_length=34)
 
     class Config:
         from_attributes = True
@@ -32,7 +34,7 @@ class AccountCreate(BaseModel):
         from_attributes = True
 
 class DepositBase(BaseModel):
-    sold: float
+    sold: Money
     name: str
     userID: int
 
@@ -40,7 +42,7 @@ class DepositBase(BaseModel):
         from_attributes = True
 
 class TransferBase(BaseModel):
-    sold: float
+    sold: Money
     name: str
     iban: str
     userID: int
@@ -49,9 +51,37 @@ class TransferBase(BaseModel):
         from_attributes = True
 
 
+class TransferItem(BaseModel):
+    sold: Money
+    name: str
+    iban: str
+
+class TransferBatch(BaseModel):
+    userID: int
+    transfers: conlist(TransferItem, min_length=1, max_length=50000)
+
 class TransferLogBase(BaseModel):
     name : str
     userID: int
+    limit: conint(ge=1, le=500) = 50
+    cursor: str | None = None
+    start_date: datetime | None = None
+    end_date: datetime | None = None
+    type: Literal["transfer", "deposit"] | None = None
+
+class StatementExport(BaseModel):
+    userID: int | None = None
+    ibans: list[str] = []
+    start_date: datetime | None = None
+    end_date: datetime | None = None
+    format: Literal["ndjson", "csv"] = "ndjson"
+
+class AccountSummary(BaseModel):
+    name: str
+    userID: int
+    start_date: date | None = None
+    end_date: date | None = None
+    granularity: Literal["day", "month"] = "month"
 
 class TransferCancelled(BaseModel):
     userID: int
@@ -77,3 +107,12 @@ class BeneficiaryCreate(BaseModel):
     name: str
     iban: str
     userID: int
+
+class BeneficiaryItem(BaseModel):
+    name: str
+    iban: str
+
+class BeneficiaryBatch(BaseModel):
+    userID: int
+    beneficiaries: conlist(BeneficiaryItem, min_length=1, max_length=10000)
+    validate_only: bool = False
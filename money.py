@@ -0,0 +1,30 @@
+"""Money is a Decimal with two places in Python and an integer number of cents in the database."""
+from decimal import Decimal, ROUND_HALF_EVEN
+from typing import Annotated
+from pydantic import Field
+from sqlalchemy import BigInteger
+from sqlalchemy.types import TypeDecorator
+
+MINOR_UNITS = 100
+CENT = Decimal("0.01")
+
+Money = Annotated[Decimal, Field(max_digits=15, decimal_places=2)]
+
+def toCents(amount) -> int:
+    if isinstance(amount, float):
+        amount = repr(amount)
+    return int((Decimal(amount) * MINOR_UNITS).to_integral_value(ROUND_HALF_EVEN))
+
+def fromCents(cents: int) -> Decimal:
+    return (Decimal(int(cents)) / MINOR_UNITS).quantize(CENT)
+
+class MoneyType(TypeDecorator):
+    """Stores amounts as integer cents so sums and comparisons in SQL stay exact."""
+    impl = BigInteger
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else toCents(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else fromCents(value)
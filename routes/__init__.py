@@ -2,5 +2,7 @@ from .auth import router as auth_router
 from .accounts import router as accounts_router
 from .transfer import router as transfer_router
 from .beneficiaries import router as beneficiaries_router
+from .metrics import router as metrics_router
+from .events import router as events_router
 
-__all__ = ['auth_router', 'accounts_router', 'transfer_router', 'beneficiaries_router']
\ No newline at end of file
+__all__ = ['auth_router', 'accounts_router', 'transfer_router', 'beneficiaries_router', 'metrics_router', 'events_router']
\ No newline at end of file
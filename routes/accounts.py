@@ -1,114 +1,153 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
+from sqlalchemy.ext.asyncio import AsyncSession
 import db
-from models import AccountCreate, DepositBase,AccountBase,AccountsRecup
+from models import AccountCreate, DepositBase,AccountBase,AccountsRecup,AccountSummary
 from services.account_service import addMoney
+from services.activity_service import activityRange, summarize
+from services.iban_directory import iban_directory
+from services.idempotency_service import idempotentResponse
+from services.response_cache import cachedResponse, invalidate, invalidateAccounts
 from services.transfer_service import transferMoney
-from utils import generate_iban
-from sqlalchemy import or_
+from iban import iban_allocator
+from sqlalchemy import select, or_, union_all
+from instrumentation import queryBudget
 
 router = APIRouter()
 
 @router.get("/users/{user_id}")
-def read_user(user_id: int, db_session: Session = Depends(db.get_db)):
-    user = db_session.query(db.User.name, db.User.email).filter(db.User.id == user_id).first()
-    if user is None:
-        raise HTTPException(status_code=404, detail="User not found")
-    return {"email": user.email, "name": user.name}
+@queryBudget(1)
+async def read_user(user_id: int, request: Request, db_session: AsyncSession = Depends(db.get_async_db)):
+    async def load():
+        user = (await db_session.execute(select(db.User.name, db.User.email).where(db.User.id == user_id))).first()
+        if user is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        return {"email": user.email, "name": user.name}, [f"user:{user_id}"]
+    return await cachedResponse(request, f"user:{user_id}", load)
 
 @router.post("/account/create")
-def account_create(body: AccountCreate, db_session: Session = Depends(db.get_db)):
-    user_query = db_session.query(db.User).where(db.User.id == body.userID)
-    user_exists = db_session.scalars(user_query).first()
+@queryBudget(3)
+async def account_create(body: AccountCreate, db_session: AsyncSession = Depends(db.get_async_db)):
+    user_query = select(db.User).where(db.User.id == body.userID)
+    user_exists = (await db_session.scalars(user_query)).first()
     if not user_exists:
         return {"error": "User does not exist"}  
       
-    account_query = db_session.query(db.Account).where(db.Account.name == body.name, db.Account.userID == body.userID)
-    account_exists = db_session.scalars(account_query).first()
+    account_query = select(db.Account).where(db.Account.name == body.name, db.Account.userID == body.userID)
+    account_exists = (await db_session.scalars(account_query)).first()
     if account_exists:
         return {"error": "Account name already exists for this user"}
 
-    new_iban: str
-    while True:
-        new_iban = generate_iban()
-        account_query = db_session.query(db.Account).where(db.Account.iban == new_iban)
-        if not db_session.scalars(account_query).first(): break
-    
+    new_iban = await iban_allocator.allocateAsync()
     account_data = AccountBase(name=body.name, sold=0, iban=new_iban)
     account = db.Account(name=account_data.name, sold=account_data.sold, userID=body.userID, iban=account_data.iban)
     db_session.add(account)
-    db_session.commit()
+    await db_session.commit()
+    iban_directory.add(account.iban, account.id, account.userID)
+    invalidate(f"accounts:{body.userID}")
     return {"message": "Account Opened"}
 
 
 @router.post("/account/infos")
-def account_get(body: AccountCreate, db_session: Session = Depends(db.get_db)):
-    account_query = db_session.query(db.Account).where(db.Account.name == body.name, db.Account.userID == body.userID)
-    account = db_session.scalars(account_query).first()
-    if account is None:
-        return {"error": "Account not found"}
-    if account.isClosed:
-        return{"error": "Account is closed"}
+@queryBudget(1)
+async def account_get(body: AccountCreate, request: Request, db_session: AsyncSession = Depends(db.get_async_db)):
+    async def load():
+        account_query = select(db.Account).where(db.Account.name == body.name, db.Account.userID == body.userID)
+        account = (await db_session.scalars(account_query)).first()
+        if account is None:
+            return {"error": "Account not found"}, None
+        if account.isClosed:
+            return{"error": "Account is closed"}, None
 
-    return {"name": account.name, "sold": account.sold, "iban": account.iban, "created_at": account.created_at.strftime("%Y-%m-%d %H:%M:%S")}
+        return {"name": account.name, "sold": account.sold, "iban": account.iban, "created_at": account.created_at.strftime("%Y-%m-%d %H:%M:%S")}, [f"account:{account.id}"]
+    return await cachedResponse(request, f"account:{body.userID}:{body.name}", load)
 
 
 @router.post("/account/deposit")
-def account_deposit(body: DepositBase, db_session: Session = Depends(db.get_db)):
-    account_query = db_session.query(db.Account).where(db.Account.name == body.name, db.Account.userID == body.userID)
-    account = db_session.scalars(account_query).first()
+@queryBudget(9)
+async def account_deposit(body: DepositBase, idempotency_key: str | None = Header(default=None), db_session: AsyncSession = Depends(db.get_async_db)):
+    return await idempotentResponse(db_session, idempotency_key, "/account/deposit", body, lambda: deposit(body, db_session))
+
+async def deposit(body: DepositBase, db_session: AsyncSession):
+    account_query = select(db.Account).where(db.Account.name == body.name, db.Account.userID == body.userID)
+    account = (await db_session.scalars(account_query)).first()
     if account is None:
         return {"error": "Account not found"}
     if account.isClosed:
         return{"error": "Invalid deposit, this account was closed"}
 
-    message = addMoney(body.sold, db_session, account)
+    message = await addMoney(body.sold, db_session, account)
     return {"message": {message}}
 
 
 
 @router.post('/account/deposit_logs')
-def account_deposit_logs(body: AccountCreate, db_session: Session = Depends(db.get_db)):
-    account_query = db_session.query(db.Account).where(db.Account.name == body.name, db.Account.userID == body.userID)
-    account = db_session.scalars(account_query).first()
+@queryBudget(2)
+async def account_deposit_logs(body: AccountCreate, db_session: AsyncSession = Depends(db.get_async_db)):
+    account_query = select(db.Account).where(db.Account.name == body.name, db.Account.userID == body.userID)
+    account = (await db_session.scalars(account_query)).first()
     if account is None:
         return {"error": "Account not found"}
 
-    deposit_query = db_session.query(db.Deposit.sold, db.Account.name).join(db.Account, db.Deposit.accountID == db.Account.id).filter(db.Deposit.accountID == account.id)
-    deposits = db_session.scalars(deposit_query).all()
+    deposit_query = union_all(*[
+        select(table.sold, table.created_at).where(table.accountID == account.id)
+        for table in (db.DepositArchive, db.Deposit)
+    ]).order_by("created_at")
+    deposits = (await db_session.scalars(deposit_query)).all()
     return {"account_name": account.name, "deposits": deposits}
 
 
-@router.post("/accounts/")
-def accounts_get(body: AccountsRecup, db_session: Session = Depends(db.get_db)):
-    user_query = db_session.query(db.User).where(db.User.id == body.userID)
-    user = db_session.scalars(user_query).first()
-    if user is None:
-        return {"error": "User does not exist"}
-    
-    account_query = db_session.query(db.Account).where(db.Account.userID == body.userID, db.Account.isClosed==False).order_by(db.Account.created_at.desc())
-    accounts = db_session.scalars(account_query).all()
-    
-    return {"accounts": [{"name": account.name, "sold": account.sold, "iban": account.iban, "date": account.created_at.strftime("%Y-%m-%d %H:%M:%S")} for account in accounts]}
+@router.post("/account/summary")
+@queryBudget(2)
+async def account_summary(body: AccountSummary, db_session: AsyncSession = Depends(db.get_async_db)):
+    """Inflow, outflow, deposits and pending exposure of an account per day or month, read from the AccountActivity totals."""
+    account_query = select(db.Account.id, db.Account.name).where(db.Account.name == body.name, db.Account.userID == body.userID)
+    account = (await db_session.execute(account_query)).first()
+    if account is None:
+        return {"error": "Account not found"}
 
+    days = (await db_session.scalars(activityRange(account.id, body.start_date, body.end_date))).all()
+    return {"account_name": account.name, "granularity": body.granularity, **summarize(days, body.granularity)}
 
+
+@router.post("/accounts/")
+@queryBudget(2)
+async def accounts_get(body: AccountsRecup, request: Request, db_session: AsyncSession = Depends(db.get_async_db)):
+    async def load():
+        user_query = select(db.User).where(db.User.id == body.userID)
+        user = (await db_session.scalars(user_query)).first()
+        if user is None:
+            return {"error": "User does not exist"}, None
+        
+        account_query = select(db.Account).where(db.Account.userID == body.userID, db.Account.isClosed==False).order_by(db.Account.created_at.desc())
+        accounts = (await db_session.scalars(account_query)).all()
+        
+        content = {"accounts": [{"name": account.name, "sold": account.sold, "iban": account.iban, "date": account.created_at.strftime("%Y-%m-%d %H:%M:%S")} for account in accounts]}
+        return content, [f"accounts:{body.userID}"] + [f"account:{account.id}" for account in accounts]
+    return await cachedResponse(request, f"accounts:{body.userID}", load)
+
+
+# Closing a funded account: the account, its pending transfers, the main account, the reservation,
+# the transfer to the main account, its activity row and the closed flag.
 @router.post("/account/close")
-def account_close(body: AccountCreate, db_session: Session = Depends(db.get_db)):
-    account_query = db_session.query(db.Account).where(db.Account.name == body.name, db.Account.userID == body.userID)
-    account = db_session.scalars(account_query).first()
+@queryBudget(7)
+async def account_close(body: AccountCreate, db_session: AsyncSession = Depends(db.get_async_db)):
+    account_query = select(db.Account).where(db.Account.name == body.name, db.Account.userID == body.userID)
+    account = (await db_session.scalars(account_query)).first()
     if account is None:
         return {"error": "Account not found"}
     if account.isMain:
         return {"error": "Main account cannot be closed"}
-    pending_query = db_session.query(db.Transfer).where(or_(db.Transfer.sourceAccountID == account.id, db.Transfer.targetAccountID == account.id), db.Transfer.status == db.TransferStatus.PENDING)
-    pending_list = db_session.scalars(pending_query).all()
+    pending_query = select(db.Transfer).where(or_(db.Transfer.sourceAccountID == account.id, db.Transfer.targetAccountID == account.id), db.Transfer.status == db.TransferStatus.PENDING)
+    pending_list = (await db_session.scalars(pending_query)).all()
     if pending_list:
         return {"error": "Account has pending transfers"}
     account.isClosed = True
-    transferMoney(db_session, account.sold, account, db_session.query(db.Account).filter(db.Account.isMain == True).first().iban)
+    main_account = (await db_session.scalars(select(db.Account).where(db.Account.userID == account.userID, db.Account.isMain == True))).first()
+    await transferMoney(db_session, account.sold, account, main_account.iban, main_account)
 
     db_session.add(account)
-    db_session.commit()
+    await db_session.commit()
+    invalidateAccounts([account.id])
     return {"message": "Account closed"}
 
 
@@ -1,49 +1,58 @@
 from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select
 import db
 from models import UserBase, UserLogin
-import hashlib
-from utils import generate_iban, create_access_token, oauth2_scheme
+from services.iban_directory import iban_directory
+from services.ledger_service import postEntries, postingEntries
+from services.password_service import hashPasswordAsync, verifyPasswordAsync, needsRehash
+from iban import iban_allocator
+from utils import create_access_token, get_current_user, invalidate_user, CurrentUser
+from instrumentation import queryBudget
 router = APIRouter()
 
 
 @router.post("/auth/register")
-def user_create(body: UserBase, db_session: Session = Depends(db.get_db)):
-    user_query = db_session.query(db.User).where(db.User.email == body.email)
-    user_exists = db_session.scalars(user_query).first()
+@queryBudget(8)
+async def user_create(body: UserBase, db_session: AsyncSession = Depends(db.get_async_db)):
+    user_query = select(db.User).where(db.User.email == body.email)
+    user_exists = (await db_session.scalars(user_query)).first()
     if user_exists:
         return {"error": "User already exists"}
     
-    hash_password = hashlib.sha256(body.password.encode()).hexdigest()
+    hash_password = await hashPasswordAsync(body.password)
     user = db.User(name= body.name, email=body.email, password=hash_password)
     db_session.add(user)
-    db_session.commit()
+    await db_session.commit()
     
-    iban: str
-    while True:
-        iban = generate_iban()
-        account_query = db_session.query(db.Account).where(db.Account.iban == iban)
-        if not db_session.scalars(account_query).first(): break
-        
+    iban = await iban_allocator.allocateAsync()
     mainAccount = db.Account(name="Principal", sold=100, userID=user.id, iban=iban, isMain=True)
     db_session.add(mainAccount)
-    db_session.commit()
+    await db_session.flush()
+    postEntries(db_session, postingEntries(db.LedgerEntryKind.OPENING, mainAccount.sold, None, mainAccount.id))
+    await db_session.commit()
+    iban_directory.add(mainAccount.iban, mainAccount.id, user.id)
 
     return {"message": "User registered"}
 
 
 @router.post("/auth/login")
-def user_login(body: UserLogin, db_session: Session = Depends(db.get_db)):
-    hash_password=hashlib.sha256(body.password.encode()).hexdigest()
-    user_query = db_session.query(db.User).where(db.User.email == body.email, db.User.password == hash_password)
-    user_exists = db_session.scalars(user_query).first()
-    if not user_exists:
+@queryBudget(2)
+async def user_login(body: UserLogin, db_session: AsyncSession = Depends(db.get_async_db)):
+    user_query = select(db.User).where(db.User.email == body.email)
+    user_exists = (await db_session.scalars(user_query)).first()
+    if not user_exists or not await verifyPasswordAsync(body.password, user_exists.password):
         return {"error": "Invalid credentials"}
-    access_token = create_access_token(data={"sub": user_exists.email})
+    if needsRehash(user_exists.password):
+        user_exists.password = await hashPasswordAsync(body.password)
+        db_session.add(user_exists)
+        await db_session.commit()
+        invalidate_user(user_exists.id)
+    access_token = create_access_token(data={"sub": user_exists.email, "uid": user_exists.id, "name": user_exists.name})
     return {"message": "User logged in", "access_token": access_token, "token_type": "bearer"}
 
 
-    
-
-
-
+@router.get("/auth/me")
+@queryBudget(1)
+async def user_me(current_user: CurrentUser = Depends(get_current_user)):
+    return {"id": current_user.id, "name": current_user.name, "email": current_user.email}
@@ -1,37 +1,41 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Request
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import insert, select
 import db
-from models import BeneficiaryCreate, BeneficiaryBase
+from models import BeneficiaryBatch, BeneficiaryCreate, BeneficiaryBase
+from services.response_cache import cachedResponse, invalidate
 from typing import List
+from instrumentation import queryBudget
 
 router = APIRouter()
 
+def beneficiaryError(user_id: int, account):
+    """Why the account behind an IBAN can't be one of user_id's beneficiaries, or None if it can."""
+    if account is not None and account.userID == user_id:
+        return "The beneficiary account is the same as the user account"
+    if account is None:
+        return "Beneficiary acccount not found"
+    if account.isClosed:
+        return "Beneficiary account is closed"
+    return None
+
 @router.post("/beneficiary/add")
-def add_beneficiary(body: BeneficiaryCreate, db_session: Session = Depends(db.get_db)):
+@queryBudget(3)
+async def add_beneficiary(body: BeneficiaryCreate, db_session: AsyncSession = Depends(db.get_async_db)):
    
-    existing_beneficiary = db_session.query(db.Beneficiary).filter(
+    existing_beneficiary = (await db_session.scalars(select(db.Beneficiary).where(
         db.Beneficiary.userID == body.userID,
         db.Beneficiary.iban == body.iban
-    ).first()
+    ))).first()
     
     if existing_beneficiary:
         raise HTTPException(status_code=400, detail="This beneficiary already exists")
     
-    user_account = db_session.query(db.Account).filter(
-        db.Account.userID == body.userID,
-        db.Account.iban == body.iban
-    ).first()
-    
-    if user_account:
-        raise HTTPException(status_code=400, detail="The beneficiary account is the same as the user account")
-    
-
-    beneficiary_account = db_session.query(db.Account).filter(
-        db.Account.iban == body.iban
-    ).first()
-    
-    if not beneficiary_account:
-        raise HTTPException(status_code=400, detail="Beneficiary acccount not found")
+    # Read from the database rather than the IBAN directory: another worker may have just closed the account.
+    account_query = select(db.Account.id, db.Account.userID, db.Account.isClosed).where(db.Account.iban == body.iban)
+    error = beneficiaryError(body.userID, (await db_session.execute(account_query)).first())
+    if error:
+        raise HTTPException(status_code=400, detail=error)
     
     
     new_beneficiary = db.Beneficiary(
@@ -41,11 +45,43 @@ def add_beneficiary(body: BeneficiaryCreate, db_session: Session = Depends(db.ge
     )
     
     db_session.add(new_beneficiary)
-    db_session.commit()
+    await db_session.commit()
+    invalidate(f"beneficiaries:{body.userID}")
     
     return {"message": "Beneficiary added successfully"}
 
+@router.post("/beneficiary/batch")
+@queryBudget(3)
+async def add_beneficiaries(body: BeneficiaryBatch, db_session: AsyncSession = Depends(db.get_async_db)):
+    """Checks many beneficiaries at once and, unless validate_only, adds the valid ones in one insert."""
+    ibans = {beneficiary.iban for beneficiary in body.beneficiaries}
+    existing_query = select(db.Beneficiary.iban).where(db.Beneficiary.userID == body.userID, db.Beneficiary.iban.in_(ibans))
+    taken = set((await db_session.scalars(existing_query)).all())
+    account_query = select(db.Account.iban, db.Account.id, db.Account.userID, db.Account.isClosed).where(db.Account.iban.in_(ibans))
+    accounts = {account.iban: account for account in (await db_session.execute(account_query)).all()}
+
+    results, rows = [], []
+    for index, beneficiary in enumerate(body.beneficiaries):
+        error = "This beneficiary already exists" if beneficiary.iban in taken else beneficiaryError(body.userID, accounts.get(beneficiary.iban))
+        if error:
+            results.append({"index": index, "error": error})
+            continue
+        # A second occurrence of the IBAN in the same batch is a duplicate too.
+        taken.add(beneficiary.iban)
+        rows.append({"name": beneficiary.name, "iban": beneficiary.iban, "userID": body.userID})
+        results.append({"index": index, "message": "Beneficiary is valid" if body.validate_only else "Beneficiary added successfully"})
+
+    if rows and not body.validate_only:
+        await db_session.execute(insert(db.Beneficiary), rows)
+        await db_session.commit()
+        invalidate(f"beneficiaries:{body.userID}")
+    return {"accepted": len(rows), "results": results}
+
 @router.get("/beneficiaries/{user_id}", response_model=List[BeneficiaryBase])
-def get_beneficiaries(user_id: int, db_session: Session = Depends(db.get_db)):
-    beneficiaries = db_session.query(db.Beneficiary).filter(db.Beneficiary.userID == user_id).all()
-    return beneficiaries
+@queryBudget(1)
+async def get_beneficiaries(user_id: int, request: Request, db_session: AsyncSession = Depends(db.get_async_db)):
+    async def load():
+        beneficiaries = (await db_session.scalars(select(db.Beneficiary).where(db.Beneficiary.userID == user_id))).all()
+        content = [BeneficiaryBase.model_validate(beneficiary, from_attributes=True).model_dump(mode="json") for beneficiary in beneficiaries]
+        return content, [f"beneficiaries:{user_id}"]
+    return await cachedResponse(request, f"beneficiaries:{user_id}", load)
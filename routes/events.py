@@ -0,0 +1,57 @@
+from fastapi import APIRouter, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+import asyncio
+import json
+import os
+from services.event_bus import event_bus
+from instrumentation import queryBudget
+
+router = APIRouter()
+
+EVENT_HEARTBEAT_SECONDS = float(os.getenv("EVENT_HEARTBEAT_SECONDS", "15"))
+
+async def eventStream(subscription, is_disconnected, heartbeat: float = EVENT_HEARTBEAT_SECONDS):
+    """Server-sent events for subscription, with a comment line whenever heartbeat seconds pass quietly."""
+    try:
+        while not await is_disconnected():
+            event = await subscription.get(heartbeat)
+            if event is None:
+                yield ": heartbeat\n\n"
+            else:
+                yield f"event: {event['type']}\ndata: {json.dumps(event, default=float)}\n\n"
+    finally:
+        event_bus.unsubscribe(subscription)
+
+@router.get("/events/stream")
+@queryBudget(0)
+async def stream_events(request: Request, userID: int, accountID: int | None = None):
+    subscription = event_bus.subscribe(userID, accountID)
+    return StreamingResponse(
+        eventStream(subscription, request.is_disconnected),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.websocket("/events/ws")
+async def websocket_events(websocket: WebSocket, userID: int, accountID: int | None = None):
+    # Subscribed before the handshake completes, so nothing published once the client is connected is missed.
+    subscription = event_bus.subscribe(userID, accountID)
+
+    async def forward():
+        # A slow client only holds up this task; the bus keeps buffering, and dropping, on its side.
+        while True:
+            event = await subscription.get()
+            await websocket.send_text(json.dumps(event, default=float))
+
+    sender = None
+    try:
+        await websocket.accept()
+        sender = asyncio.create_task(forward())
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if sender is not None:
+            sender.cancel()
+        event_bus.unsubscribe(subscription)
@@ -0,0 +1,11 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from metrics import render
+from instrumentation import queryBudget
+
+router = APIRouter()
+
+@router.get("/metrics", response_class=PlainTextResponse)
+@queryBudget(0)
+async def read_metrics():
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
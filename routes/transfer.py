@@ -1,71 +1,104 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 import db
-from models import TransferBase, TransferLogBase, TransferCancelled
-from services.transfer_service import transferMoney
-from sqlalchemy import select, literal, union, or_
-from sqlalchemy.orm import Session, aliased
+from models import TransferBase, TransferBatch, TransferLogBase, TransferCancelled, StatementExport
+from services.account_service import releaseFunds
+from services.transfer_service import transferMoney, transferMoneyBatch
+from services.iban_directory import iban_directory
+from services.idempotency_service import idempotentResponse
+from services.activity_service import activityRows, activityUpsert, transferCancelledActivity
+from services.event_bus import event_bus, transferEvent
+from services.history_service import transactionHistory, encodeCursor, decodeCursor, statementRows
+from sqlalchemy import select, and_, or_, union_all, update
+from sqlalchemy.orm import aliased
+import csv
+import io
+import json
+from instrumentation import queryBudget
 
 router = APIRouter()
 
+STATEMENT_FIELDS = ["account_iban", "account_name", "id", "type", "amount", "date", "from_account", "to_account", "status"]
+
+def statementLine(account, row):
+    return {
+        "account_iban": account.iban,
+        "account_name": account.name,
+        "id": row.id,
+        "type": row.type,
+        "amount": row.sold,
+        "date": row.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+        "from_account": row.source_account,
+        "to_account": row.target_account,
+        "status": row.status.value if row.status else None
+    }
+
+async def ndjsonLines(rows):
+    async for account, row in rows:
+        yield json.dumps(statementLine(account, row), default=float) + "\n"
+
+async def csvLines(rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, STATEMENT_FIELDS)
+    writer.writeheader()
+    async for account, row in rows:
+        writer.writerow(statementLine(account, row))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
 @router.post("/account/transfer")
-def account_transfer(body: TransferBase, db_session: Session = Depends(db.get_db)):
-    account_query = db_session.query(db.Account).where(db.Account.name == body.name, db.Account.userID == body.userID)
-    account = db_session.scalars(account_query).first()
+@queryBudget(7)
+async def account_transfer(body: TransferBase, idempotency_key: str | None = Header(default=None), db_session: AsyncSession = Depends(db.get_async_db)):
+    return await idempotentResponse(db_session, idempotency_key, "/account/transfer", body, lambda: transfer(body, db_session))
+
+async def transfer(body: TransferBase, db_session: AsyncSession):
+    # The directory names the target; its closed flag is read with the source, since another worker may have closed it.
+    target = await iban_directory.lookup(db_session, body.iban)
+    source_condition = and_(db.Account.name == body.name, db.Account.userID == body.userID)
+    account_query = select(db.Account).where(source_condition if target is None else or_(source_condition, db.Account.id == target.id))
+    accounts = (await db_session.scalars(account_query)).all()
+    account = next((account for account in accounts if account.name == body.name and account.userID == body.userID), None)
     if account is None:
         return {"error": "Account not found"}
     if account.isClosed:
         return{"error": "Invalid transfer, the source account is closed"}
-    ibanClosed_query = db_session.query(db.Account).where(db.Account.iban == body.iban)
-    accountClosed = db_session.scalars(ibanClosed_query).first()
-    if accountClosed.isClosed:
-        return{"error": "Invalid transfer, the target account is closed"}
+    if target is not None:
+        target = next(account for account in accounts if account.id == target.id)
+        if target.isClosed:
+            return{"error": "Invalid transfer, the target account is closed"}
 
-    message = transferMoney(db_session, body.sold, account, body.iban)
+    message = await transferMoney(db_session, body.sold, account, body.iban, target)
     return {"message": {message}}
 
+@router.post("/account/transfer/batch")
+@queryBudget(6)
+async def account_transfer_batch(body: TransferBatch, idempotency_key: str | None = Header(default=None), db_session: AsyncSession = Depends(db.get_async_db)):
+    return await idempotentResponse(db_session, idempotency_key, "/account/transfer/batch", body, lambda: transferBatch(body, db_session))
+
+async def transferBatch(body: TransferBatch, db_session: AsyncSession):
+    results = await transferMoneyBatch(db_session, body.userID, body.transfers)
+    return {"accepted": sum("message" in result for result in results), "results": results}
+
 @router.post('/account/transaction_logs')
-def account_transaction_logs(body: TransferLogBase, db_session: Session = Depends(db.get_db)):
-    account_query = db_session.query(db.Account).where(db.Account.name == body.name, db.Account.userID == body.userID)
-    account = db_session.scalars(account_query).first()
+@queryBudget(4)
+async def account_transaction_logs(body: TransferLogBase, db_session: AsyncSession = Depends(db.get_async_db)):
+    account_query = select(db.Account).where(db.Account.name == body.name, db.Account.userID == body.userID)
+    account = (await db_session.scalars(account_query)).first()
     if account is None:
         return {"error": "Account not found"}
 
-    TargetAccount = aliased(db.Account)
-    
-    transfer_query = (
-        select(
-            db.Transfer.sold,
-            db.Transfer.created_at,
-            db.Account.name.label('source_account'),
-            TargetAccount.name.label('target_account'),
-            literal('transfer').label('type'),
-            db.Transfer.status
-        )
-        .join(db.Account, db.Transfer.sourceAccountID == db.Account.id)
-        .join(TargetAccount, db.Transfer.targetAccountID == TargetAccount.id)
-        .where(or_(db.Transfer.sourceAccountID == account.id, db.Transfer.targetAccountID == account.id))
-    )
-    
-    deposit_query = (
-        select(
-            db.Deposit.sold,
-            db.Deposit.created_at,
-            db.Account.name.label('source_account'),
-            literal(None).label('target_account'),
-            literal('deposit').label('type'),
-            literal(None).label('status')
-        )
-        .join(db.Account, db.Deposit.accountID == db.Account.id)
-        .where(db.Deposit.accountID == account.id)
-    )
-    
-    combined_query = union(transfer_query, deposit_query)
-    results = db_session.exec(combined_query).all()
-    sorted_results = sorted(results, key=lambda x: x.created_at, reverse=True)
+    try:
+        cursor = decodeCursor(body.cursor) if body.cursor else None
+    except ValueError:
+        return {"error": "Invalid cursor"}
+
+    results = await transactionHistory(db_session, account.id, body.limit + 1, cursor, body.start_date, body.end_date, body.type)
+    page = results[:body.limit]
     
     transaction_logs = []
-    for result in sorted_results:
+    for result in page:
         log = {
             "amount": result.sold,
             "date": result.created_at.strftime("%Y-%m-%d %H:%M:%S") if result.created_at else None,
@@ -80,42 +113,92 @@ def account_transaction_logs(body: TransferLogBase, db_session: Session = Depend
     
     return {
         "account_name": account.name,
-        "transactions": transaction_logs
+        "transactions": transaction_logs,
+        "next_cursor": encodeCursor(page[-1]) if len(results) > body.limit else None
     }
     
+@router.post("/account/statements/export")
+@queryBudget(3)
+async def account_statements_export(body: StatementExport, db_session: AsyncSession = Depends(db.get_async_db)):
+    conditions = []
+    if body.userID is not None:
+        conditions.append(db.Account.userID == body.userID)
+    if body.ibans:
+        conditions.append(db.Account.iban.in_(body.ibans))
+    if not conditions:
+        return {"error": "A userID or a list of IBANs is required"}
+
+    account_query = select(db.Account.id, db.Account.iban, db.Account.name).where(or_(*conditions)).order_by(db.Account.id)
+    accounts = (await db_session.execute(account_query)).all()
+
+    rows = statementRows(accounts, body.start_date, body.end_date)
+    if body.format == "csv":
+        return StreamingResponse(csvLines(rows), media_type="text/csv")
+    return StreamingResponse(ndjsonLines(rows), media_type="application/x-ndjson")
+
 @router.post("/transfer/canceled")
-def cancelledTransfer(body: TransferCancelled, db_session: Session = Depends(db.get_db)):
-    transfer_query = db_session.query(db.Transfer).where(db.Transfer.id == body.transferID, db.Transfer.userID == body.userID)
-    transfer = db_session.scalars(transfer_query).first()
-    if transfer is None:
-        return {"error": "Transfer not found"}
-    if transfer.status == db.TransferStatus.COMPLETED:
-        return {"error": "Transfer already completed"}
-    transfer.status = db.TransferStatus.CANCELLED
-    db_session.add(transfer)
-    db_session.commit()
+@queryBudget(4)
+async def cancelledTransfer(body: TransferCancelled, db_session: AsyncSession = Depends(db.get_async_db)):
+    # Only a still pending transfer is cancelled, so one settling at the same time can't be both.
+    cancel_query = (
+        update(db.Transfer)
+        .where(db.Transfer.id == body.transferID, db.Transfer.userID == body.userID, db.Transfer.status == db.TransferStatus.PENDING)
+        .values(status=db.TransferStatus.CANCELLED, claimedBy=None, claimExpiresAt=None)
+        .returning(db.Transfer.sourceAccountID, db.Transfer.targetAccountID, db.Transfer.sold, db.Transfer.created_at)
+        .execution_options(synchronize_session=False)
+    )
+    cancelled = (await db_session.execute(cancel_query)).first()
+    if cancelled is None:
+        status_query = union_all(*[
+            select(table.status).where(table.id == body.transferID, table.userID == body.userID)
+            for table in (db.Transfer, db.TransferArchive)
+        ])
+        status = (await db_session.scalars(status_query)).first()
+        if status is None:
+            return {"error": "Transfer not found"}
+        if status == db.TransferStatus.COMPLETED:
+            return {"error": "Transfer already completed"}
+        return {"message": "Transfer cancelled"}
+    await db_session.execute(releaseFunds(cancelled.sourceAccountID, cancelled.sold))
+    activity = transferCancelledActivity(cancelled.sourceAccountID, cancelled.created_at.date(), cancelled.sold)
+    await db_session.execute(activityUpsert(), activityRows(activity))
+    await db_session.commit()
+    if len(event_bus):
+        target_owner = await db_session.scalar(select(db.Account.userID).where(db.Account.id == cancelled.targetAccountID))
+        event = transferEvent(body.transferID, db.TransferStatus.CANCELLED, cancelled.sold, cancelled.sourceAccountID, cancelled.targetAccountID)
+        event_bus.publish(event, {body.userID, target_owner}, {cancelled.sourceAccountID, cancelled.targetAccountID})
     return {"message": "Transfer cancelled"}
 
 @router.post("/transfer/info")
-def transfer_info(body: TransferCancelled, db_session: Session = Depends(db.get_db)):
-    transfer_query = db_session.query(db.Transfer).where(db.Transfer.id == body.transferID, db.Transfer.userID == body.userID)
-    transfer = db_session.scalars(transfer_query).first()
-    if transfer is None:
+@queryBudget(2)
+async def transfer_info(body: TransferCancelled, db_session: AsyncSession = Depends(db.get_async_db)):
+    source_account = aliased(db.Account)
+    target_account = aliased(db.Account)
+    # The archive is only read for a transfer no longer in the live table.
+    for table in (db.Transfer, db.TransferArchive):
+        transfer_query = (
+            select(table.sold, table.status, source_account.name.label("source_name"), target_account.name.label("target_name"))
+            .outerjoin(source_account, source_account.id == table.sourceAccountID)
+            .outerjoin(target_account, target_account.id == table.targetAccountID)
+            .where(table.id == body.transferID, table.userID == body.userID)
+        )
+        transfer = (await db_session.execute(transfer_query)).first()
+        if transfer is not None:
+            break
+    else:
         return {"error": "Transfer not found"}
     
-    source_account = db_session.query(db.Account).filter(db.Account.id == transfer.sourceAccountID).first()
-    target_account = db_session.query(db.Account).filter(db.Account.id == transfer.targetAccountID).first()
-    
     return {
         "amount": transfer.sold,
-        "source_account": source_account.name if source_account else "Unknown",
-        "target_account": target_account.name if target_account else "Unknown",
+        "source_account": transfer.source_name or "Unknown",
+        "target_account": transfer.target_name or "Unknown",
         "status": transfer.status.value
     }
 
 @router.post("/transfer/last")
-def get_last_transfer(db_session: Session = Depends(db.get_db)):
-    last_transfer = db_session.query(db.Transfer).order_by(db.Transfer.created_at.desc()).first()
+@queryBudget(1)
+async def get_last_transfer(db_session: AsyncSession = Depends(db.get_async_db)):
+    last_transfer = (await db_session.scalars(select(db.Transfer).order_by(db.Transfer.created_at.desc()))).first()
 
     if last_transfer is None:
         return {"error": "No transfers found"}
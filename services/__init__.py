@@ -1,2 +1,3 @@
-from .account_service import addMoney, getAccount
-from .transfer_service import transferMoney, isTransferPossible
\ No newline at end of file
+from .account_service import addMoney
+from .transfer_service import transferMoney, transferMoneyBatch, isTransferPossible
+from .settlement_service import settleTransfers
\ No newline at end of file
@@ -1,19 +1,66 @@
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 import db
-from sqlalchemy import select
+from decimal import Decimal
+from sqlalchemy import case, literal, update
+from sqlalchemy.orm.attributes import set_committed_value
+from money import MoneyType
+from .activity_service import activityRows, activityUpsert, depositActivity
+from .event_bus import publishBalance
+from .ledger_service import postEntries, postingEntries
+from .response_cache import invalidateAccounts
 
-def addMoney(amount: float, session: Session, account: db.Account):
+def balanceUpdate(account_id: int, delta: Decimal, minimum: Decimal | None = None):
+    """Adds delta to the balance inside the database, so concurrent writers can't overwrite each other.
+
+    With a minimum, the row is left untouched (and nothing is returned) when the
+    balance would drop below it.
+    """
+    query = (
+        update(db.Account)
+        .where(db.Account.id == account_id)
+        .values(sold=db.Account.sold + delta)
+    )
+    if minimum is not None:
+        query = query.where(db.Account.sold >= minimum - delta)
+    return query.returning(db.Account.sold).execution_options(synchronize_session=False)
+
+def reserveFunds(amounts: dict):
+    """Reserves amounts[account_id] on every account whose available balance (sold - reserved) covers it.
+
+    Returns the ids of the accounts reserved on; the others are left untouched.
+    """
+    amount = case({account_id: literal(value, MoneyType) for account_id, value in amounts.items()}, value=db.Account.id)
+    return (
+        update(db.Account)
+        .where(db.Account.id.in_(list(amounts)), db.Account.sold - db.Account.reserved >= amount)
+        .values(reserved=db.Account.reserved + amount)
+        .returning(db.Account.id)
+        .execution_options(synchronize_session=False)
+    )
+
+def releaseFunds(account_id: int, amount: Decimal):
+    """Gives back what a transfer reserved when it is cancelled."""
+    return (
+        update(db.Account)
+        .where(db.Account.id == account_id)
+        .values(reserved=db.Account.reserved - amount)
+        .execution_options(synchronize_session=False)
+    )
+
+async def addMoney(amount: Decimal, session: AsyncSession, account: db.Account):
     if amount > 0:
-        account.sold = account.sold + amount
+        new_sold = (await session.execute(balanceUpdate(account.id, amount))).scalar_one()
+        # The row was already written; record the new balance without marking it for another flush.
+        set_committed_value(account, "sold", new_sold)
         depotData = db.Deposit(sold=amount, userID=account.userID, accountID=account.id)
         session.add(depotData)
-        session.add(account)
-        session.commit()
+        await session.flush()
+        postEntries(session, postingEntries(db.LedgerEntryKind.DEPOSIT, amount, depotData.id, account.id))
+        await session.execute(activityUpsert(), activityRows(depositActivity(account.id, depotData.created_at.date(), amount)))
+        await session.commit()
+        invalidateAccounts([account.id])
+        publishBalance(account.id, account.userID, new_sold)
         return "Money added successfully to account"
         
     else:
         return "Invalid amount, must be superior to 0"
-
-def getAccount(session: Session, iban: str):
-    account_query = select(db.Account).where(db.Account.iban == iban)
-    return session.scalars(account_query).first()
\ No newline at end of file
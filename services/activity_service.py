@@ -0,0 +1,79 @@
+"""Per account and day totals behind /account/summary.
+
+Writers describe what happened with the helpers below and apply the result
+with one upsert in the transaction that moved the money, so the summary never
+has to scan Deposit or Transfer rows.
+"""
+from collections import defaultdict
+from datetime import date
+from decimal import Decimal
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite
+import db
+
+COUNTERS = ("deposits", "depositTotal", "transfersIn", "inflow", "transfersOut", "outflow", "pending", "pendingOut")
+
+def depositActivity(account_id: int, day: date, amount: Decimal):
+    return [(account_id, day, {"deposits": 1, "depositTotal": amount})]
+
+def transferCreatedActivity(source_id: int, created_on: date, amount: Decimal):
+    return [(source_id, created_on, {"pending": 1, "pendingOut": amount})]
+
+def transferCancelledActivity(source_id: int, created_on: date, amount: Decimal):
+    return [(source_id, created_on, {"pending": -1, "pendingOut": -amount})]
+
+def transferMovedActivity(source_id: int, target_id: int, settled_on: date, amount: Decimal):
+    return [
+        (source_id, settled_on, {"transfersOut": 1, "outflow": amount}),
+        (target_id, settled_on, {"transfersIn": 1, "inflow": amount}),
+    ]
+
+def transferSettledActivity(source_id: int, target_id: int, created_on: date, settled_on: date, amount: Decimal, moved: bool = True):
+    """A settled transfer leaves the pending totals; when the source could cover it, the money counts as out and in."""
+    changes = transferCancelledActivity(source_id, created_on, amount)
+    if moved:
+        changes += transferMovedActivity(source_id, target_id, settled_on, amount)
+    return changes
+
+def activityRows(changes):
+    """Sums the changes per (account, day), one row with every counter each, ready for activityUpsert()."""
+    totals = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+    for account_id, day, amounts in changes:
+        row = totals[account_id, day]
+        for name, value in amounts.items():
+            row[name] += value
+    return [{"accountID": account_id, "day": day, **row} for (account_id, day), row in totals.items()]
+
+def activityUpsert():
+    """Adds each row's counters to the stored ones, creating the (account, day) row if needed."""
+    dialect = postgresql if db.engine.dialect.name == "postgresql" else sqlite
+    query = dialect.insert(db.AccountActivity)
+    return query.on_conflict_do_update(
+        index_elements=[db.AccountActivity.accountID, db.AccountActivity.day],
+        set_={name: getattr(db.AccountActivity, name) + getattr(query.excluded, name) for name in COUNTERS}
+    )
+
+def activityRange(account_id: int, start: date | None, end: date | None):
+    query = select(db.AccountActivity).where(db.AccountActivity.accountID == account_id).order_by(db.AccountActivity.day)
+    if start is not None:
+        query = query.where(db.AccountActivity.day >= start)
+    if end is not None:
+        query = query.where(db.AccountActivity.day < end)
+    return query
+
+def summarize(days, granularity: str):
+    """Folds daily rows into one period per day or per month, plus the totals of the whole range."""
+    periods = {}
+    for activity in days:
+        period = activity.day if granularity == "day" else activity.day.replace(day=1)
+        totals = periods.setdefault(period, dict.fromkeys(COUNTERS, 0))
+        for name in COUNTERS:
+            totals[name] += getattr(activity, name)
+    overall = dict.fromkeys(COUNTERS, 0)
+    for totals in periods.values():
+        for name in COUNTERS:
+            overall[name] += totals[name]
+    return {
+        "periods": [{"period": period.isoformat(), **totals} for period, totals in periods.items()],
+        "totals": overall,
+    }
@@ -0,0 +1,71 @@
+"""Moves finished transfers and deposits past the archive horizon out of the live tables.
+
+Balances live in account.sold and the ledger, and summaries in accountactivity,
+so neither changes when rows move. Each batch records the newest created_at it
+moved in archivemark, and history reads the archive tables as well when the
+requested range starts at or before it.
+"""
+from datetime import datetime, timedelta
+from typing import NamedTuple
+import os
+import time
+from sqlalchemy import delete, func, insert, or_, select, update
+from sqlalchemy.orm import Session
+import db
+from metrics import Counter
+
+ARCHIVE_AFTER = timedelta(days=float(os.getenv("ARCHIVE_AFTER_DAYS", "90")))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "5000"))
+
+archived_rows = Counter("archived_rows_total", "Rows moved to the archive tables", ["table"])
+
+class ArchiveResult(NamedTuple):
+    transfers: int
+    deposits: int
+    duration: float
+
+def archiveBoundary(now: datetime | None = None):
+    """Finished rows created before this are archived by archiveHistory(now)."""
+    return (now or datetime.utcnow()) - ARCHIVE_AFTER
+
+def _raiseMark(session: Session, name: str, newest: datetime):
+    raise_mark = (
+        update(db.ArchiveMark)
+        .where(db.ArchiveMark.name == name, or_(db.ArchiveMark.newest.is_(None), db.ArchiveMark.newest < newest))
+        .values(newest=newest)
+        .execution_options(synchronize_session=False)
+    )
+    if session.execute(raise_mark).rowcount == 0 and session.get(db.ArchiveMark, name) is None:
+        session.add(db.ArchiveMark(name=name, newest=newest))
+
+def _moveBatch(session: Session, live, archive, conditions, batch_size: int):
+    # Never the newest row: SQLite hands out max(id) + 1, and a new row must not reuse an archived id.
+    newest = select(func.max(live.id)).scalar_subquery()
+    rows = session.execute(select(live.id, live.created_at).where(*conditions, live.id < newest).order_by(live.id).limit(batch_size)).all()
+    if not rows:
+        return 0
+    ids = [row.id for row in rows]
+    columns = [column.name for column in archive.__table__.columns]
+    session.execute(insert(archive).from_select(columns, select(*[getattr(live, name) for name in columns]).where(live.id.in_(ids))))
+    session.execute(delete(live).where(live.id.in_(ids)))
+    # Committed with the rows, so a reader never sees them archived but not covered by the mark.
+    _raiseMark(session, live.__tablename__, max(row.created_at for row in rows))
+    session.commit()
+    archived_rows.inc(len(ids), table=live.__tablename__)
+    return len(ids)
+
+def archiveHistory(session: Session, now: datetime | None = None, batch_size: int = ARCHIVE_BATCH_SIZE):
+    """Archives completed and cancelled transfers, and deposits, created before archiveBoundary(now).
+
+    Each batch is copied and deleted in its own transaction, so the live tables
+    stay writable while a large backlog is moved.
+    """
+    started = time.perf_counter()
+    boundary = archiveBoundary(now)
+    finished = [db.Transfer.status.in_([db.TransferStatus.COMPLETED, db.TransferStatus.CANCELLED]), db.Transfer.created_at < boundary]
+    transfers = deposits = 0
+    while moved := _moveBatch(session, db.Transfer, db.TransferArchive, finished, batch_size):
+        transfers += moved
+    while moved := _moveBatch(session, db.Deposit, db.DepositArchive, [db.Deposit.created_at < boundary], batch_size):
+        deposits += moved
+    return ArchiveResult(transfers, deposits, time.perf_counter() - started)
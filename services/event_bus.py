@@ -0,0 +1,113 @@
+"""In-process pub/sub of transfer and balance changes, behind /events/ws and /events/stream.
+
+Publishers call publish() after their transaction commits, from a request or
+from the settlement thread. It never blocks: each subscriber has a bounded
+buffer on its own event loop, and a subscriber that falls behind loses its
+oldest events and is told how many with an "overflow" event.
+"""
+import asyncio
+from collections import deque
+from datetime import datetime
+from decimal import Decimal
+import os
+import threading
+import db
+from metrics import Counter, Gauge
+
+EVENT_BUFFER_SIZE = int(os.getenv("EVENT_BUFFER_SIZE", "100"))
+
+events_published = Counter("events_published_total", "Events published, by type", ["type"])
+events_dropped = Counter("events_dropped_total", "Events dropped because a subscriber's buffer was full")
+event_subscribers = Gauge("event_subscribers", "Open event stream subscriptions")
+
+class Subscription:
+    """Events for one user, optionally narrowed to one of their accounts, buffered for one client."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, user_id: int, account_id: int | None = None, max_size: int = EVENT_BUFFER_SIZE):
+        self.loop = loop
+        self.user_id = user_id
+        self.account_id = account_id
+        self.dropped = 0
+        self._buffer = deque(maxlen=max_size)
+        self._ready = asyncio.Event()
+
+    def matches(self, users, accounts):
+        return self.user_id in users and (self.account_id is None or self.account_id in accounts)
+
+    def _put(self, event: dict):
+        # Runs on the subscriber's loop; a full deque discards its oldest event.
+        if len(self._buffer) == self._buffer.maxlen:
+            self.dropped += 1
+            events_dropped.inc()
+        self._buffer.append(event)
+        self._ready.set()
+
+    async def get(self, timeout: float | None = None):
+        """The next event, or None if none came within timeout."""
+        if not self._buffer:
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            return {"type": "overflow", "dropped": dropped}
+        return self._buffer.popleft()
+
+class EventBus:
+    def __init__(self):
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id: int, account_id: int | None = None, max_size: int = EVENT_BUFFER_SIZE):
+        """Must be called from the event loop that will read the subscription."""
+        subscription = Subscription(asyncio.get_running_loop(), user_id, account_id, max_size)
+        with self._lock:
+            self._subscriptions.add(subscription)
+            event_subscribers.set(len(self._subscriptions))
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+            event_subscribers.set(len(self._subscriptions))
+
+    def publish(self, event: dict, users, accounts):
+        """Hands event to every subscription of one of users (and, if narrowed, of one of accounts)."""
+        events_published.inc(type=event["type"])
+        with self._lock:
+            targets = [subscription for subscription in self._subscriptions if subscription.matches(users, accounts)]
+        for subscription in targets:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription._put, event)
+            except RuntimeError:
+                # The client's loop is gone; it will never read again.
+                self.unsubscribe(subscription)
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+event_bus = EventBus()
+
+def transferEvent(transfer_id: int, status: db.TransferStatus, amount: Decimal, source_id: int, target_id: int):
+    return {
+        "type": "transfer",
+        "transferID": transfer_id,
+        "status": status.value,
+        "amount": amount,
+        "sourceAccountID": source_id,
+        "targetAccountID": target_id,
+        "at": datetime.utcnow().isoformat(),
+    }
+
+def balanceEvent(account_id: int, sold: Decimal):
+    return {"type": "balance", "accountID": account_id, "sold": sold, "at": datetime.utcnow().isoformat()}
+
+def publishTransfer(transfer_id: int, status: db.TransferStatus, amount: Decimal, source, target):
+    """source and target are anything with id and userID: accounts, directory entries."""
+    event = transferEvent(transfer_id, status, amount, source.id, target.id)
+    event_bus.publish(event, {source.userID, target.userID}, {source.id, target.id})
+
+def publishBalance(account_id: int, user_id: int, sold: Decimal):
+    event_bus.publish(balanceEvent(account_id, sold), {user_id}, {account_id})
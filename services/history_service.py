@@ -0,0 +1,156 @@
+from datetime import datetime
+import base64
+import json
+from sqlalchemy import and_, false, func, literal, or_, select, true, union_all
+from sqlalchemy.orm import aliased
+import db
+
+def encodeCursor(row):
+    position = [row.created_at.isoformat(), row.type, row.id]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+def decodeCursor(cursor: str):
+    """Raises ValueError when the cursor wasn't produced by encodeCursor."""
+    try:
+        created_at, kind, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), str(kind), int(row_id)
+    except (TypeError, ValueError, json.JSONDecodeError) as error:
+        raise ValueError("Invalid cursor") from error
+
+def _afterCursor(created_at_column, id_column, kind: str, cursor):
+    """Rows that come after the cursor in (created_at, type, id) descending order."""
+    if cursor is None:
+        return true()
+    created_at, cursor_kind, cursor_id = cursor
+    if kind < cursor_kind:
+        tie = true()
+    elif kind > cursor_kind:
+        tie = false()
+    else:
+        tie = id_column < cursor_id
+    return or_(created_at_column < created_at, and_(created_at_column == created_at, tie))
+
+def _inRange(created_at_column, start: datetime | None, end: datetime | None):
+    conditions = []
+    if start is not None:
+        conditions.append(created_at_column >= start)
+    if end is not None:
+        conditions.append(created_at_column < end)
+    return and_(true(), *conditions)
+
+def _accountIs(column, account_ids):
+    # A plain equality for one account keeps the (account, created_at) index usable for the ordering.
+    return column == account_ids[0] if len(account_ids) == 1 else column.in_(account_ids)
+
+HISTORY_TABLES = (db.Transfer, db.Deposit)
+ARCHIVE_TABLES = (db.TransferArchive, db.DepositArchive)
+
+def _historyBranches(account_ids: list[int], start: datetime | None, end: datetime | None, kind: str | None, cursor=None, archived: bool = False):
+    """One select per index walked: outgoing transfers, incoming transfers, deposits, and the same in the archive if archived.
+
+    Rows carry the account_id of the statement they belong to, so a transfer
+    between two of the listed accounts appears once for each.
+    """
+    branches = []
+    for Transfer, Deposit in (HISTORY_TABLES, ARCHIVE_TABLES) if archived else (HISTORY_TABLES,):
+        if kind in (None, "transfer"):
+            SourceAccount = aliased(db.Account)
+            TargetAccount = aliased(db.Account)
+            for account_column in (Transfer.sourceAccountID, Transfer.targetAccountID):
+                branches.append((
+                    select(
+                        Transfer.id,
+                        Transfer.sold,
+                        Transfer.created_at,
+                        SourceAccount.name.label('source_account'),
+                        TargetAccount.name.label('target_account'),
+                        literal('transfer').label('type'),
+                        Transfer.status,
+                        account_column.label('account_id')
+                    )
+                    .join(SourceAccount, Transfer.sourceAccountID == SourceAccount.id)
+                    .join(TargetAccount, Transfer.targetAccountID == TargetAccount.id)
+                    .where(
+                        _accountIs(account_column, account_ids),
+                        _inRange(Transfer.created_at, start, end),
+                        _afterCursor(Transfer.created_at, Transfer.id, "transfer", cursor)
+                    ),
+                    Transfer
+                ))
+        if kind in (None, "deposit"):
+            branches.append((
+                select(
+                    Deposit.id,
+                    Deposit.sold,
+                    Deposit.created_at,
+                    db.Account.name.label('source_account'),
+                    literal(None).label('target_account'),
+                    literal('deposit').label('type'),
+                    literal(None).label('status'),
+                    Deposit.accountID.label('account_id')
+                )
+                .join(db.Account, Deposit.accountID == db.Account.id)
+                .where(
+                    _accountIs(Deposit.accountID, account_ids),
+                    _inRange(Deposit.created_at, start, end),
+                    _afterCursor(Deposit.created_at, Deposit.id, "deposit", cursor)
+                ),
+                Deposit
+            ))
+    return branches
+
+def archivedUntilQuery():
+    """The newest created_at ever archived, None while the archive is empty."""
+    return select(func.max(db.ArchiveMark.newest))
+
+def reachesArchive(start: datetime | None, archived_until: datetime | None):
+    return archived_until is not None and (start is None or start <= archived_until)
+
+def transactionHistoryQuery(account_id: int, limit: int, cursor=None, start: datetime | None = None, end: datetime | None = None, kind: str | None = None, archived: bool = False):
+    """Newest-first page of an account's transfers and deposits.
+
+    Each branch is bounded by its own index and LIMIT before the union is sorted, so
+    a page costs the same whatever the length of the history.
+    """
+    branches = [
+        select(branch.order_by(table.created_at.desc(), table.id.desc()).limit(limit).subquery())
+        for branch, table in _historyBranches([account_id], start, end, kind, cursor, archived)
+    ]
+    combined = union_all(*branches).subquery()
+    return (
+        select(combined)
+        .order_by(combined.c.created_at.desc(), combined.c.type.desc(), combined.c.id.desc())
+        .limit(limit)
+    )
+
+async def transactionHistory(session, account_id: int, limit: int, cursor=None, start: datetime | None = None, end: datetime | None = None, kind: str | None = None):
+    """Up to limit rows of transactionHistoryQuery, reading the archive only when the page can reach it.
+
+    No archived row is newer than the archive mark, so a page the live tables
+    fill with rows newer than it is already complete.
+    """
+    archived_until = await session.scalar(archivedUntilQuery())
+    rows = (await session.execute(transactionHistoryQuery(account_id, limit, cursor, start, end, kind))).all()
+    if not reachesArchive(start, archived_until) or (len(rows) == limit and rows[-1].created_at > archived_until):
+        return rows
+    return (await session.execute(transactionHistoryQuery(account_id, limit, cursor, start, end, kind, archived=True))).all()
+
+def statementQuery(account_ids: list[int], start: datetime | None = None, end: datetime | None = None, archived: bool = False):
+    """Every transfer and deposit of the accounts in the range, account by account, oldest first."""
+    branches = [branch for branch, table in _historyBranches(account_ids, start, end, None, archived=archived)]
+    combined = union_all(*branches).subquery()
+    return select(combined).order_by(combined.c.account_id, combined.c.created_at, combined.c.type, combined.c.id)
+
+async def statementRows(accounts, start: datetime | None = None, end: datetime | None = None):
+    """Streams (account, row) pairs account by account from one server-side cursor.
+
+    Opens its own session: the request's one is closed before a streamed body is sent.
+    """
+    if not accounts:
+        return
+    by_id = {account.id: account for account in accounts}
+    async with db.open_async_session() as session:
+        archived = reachesArchive(start, await session.scalar(archivedUntilQuery()))
+        result = await session.stream(statementQuery(list(by_id), start, end, archived))
+        async for row in result:
+            yield by_id[row.account_id], row
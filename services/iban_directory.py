@@ -0,0 +1,98 @@
+"""IBAN -> account lookups answered from memory.
+
+Transfers only need to know which account an IBAN names and who owns it. The
+directory keeps exactly that for every account, so resolving a target doesn't
+cost a query. Neither changes once an account exists, so the directory is
+never stale for an IBAN it holds. Whether the account is closed does change,
+and can be changed by another process, so callers read that from the database.
+"""
+from array import array
+import os
+import threading
+from typing import NamedTuple
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+import db
+from metrics import Counter, Gauge
+
+IBAN_DIRECTORY_REFRESH_SECONDS = int(os.getenv("IBAN_DIRECTORY_REFRESH_SECONDS", "300"))
+
+directory_lookups = Counter("iban_directory_lookups_total", "IBAN lookups by whether the directory already knew the account", ["result"])
+directory_size = Gauge("iban_directory_accounts", "Accounts held in the IBAN directory")
+
+class DirectoryEntry(NamedTuple):
+    id: int
+    userID: int
+
+class IbanDirectory:
+    """Every account's id and owner, by IBAN.
+
+    Rows are kept in parallel arrays indexed from one dict rather than as an
+    object per account, so a million accounts cost the dict and its IBANs
+    plus 16 bytes each. load() fills it at startup and refreshes it
+    periodically; add() records the accounts this process opens. An IBAN it
+    doesn't know, such as an account another process just opened, is looked
+    up in the database and remembered.
+    """
+
+    def __init__(self):
+        self._slots = {}
+        self._ids = array("q")
+        self._owners = array("q")
+        self._lock = threading.Lock()
+
+    def load(self, session: Session):
+        slots, ids, owners = {}, array("q"), array("q")
+        account_query = select(db.Account.iban, db.Account.id, db.Account.userID)
+        for slot, account in enumerate(session.execute(account_query)):
+            slots[account.iban] = slot
+            ids.append(account.id)
+            owners.append(account.userID)
+        with self._lock:
+            self._slots, self._ids, self._owners = slots, ids, owners
+        directory_size.set(len(slots))
+
+    def add(self, iban: str, account_id: int, user_id: int):
+        with self._lock:
+            slot = self._slots.get(iban)
+            if slot is None:
+                self._slots[iban] = len(self._ids)
+                self._ids.append(account_id)
+                self._owners.append(user_id)
+            else:
+                self._ids[slot], self._owners[slot] = account_id, user_id
+        directory_size.set(len(self._slots))
+
+    def get(self, iban: str):
+        """The entry for iban if the directory holds it, without touching the database."""
+        with self._lock:
+            slot = self._slots.get(iban)
+            if slot is None:
+                return None
+            return DirectoryEntry(self._ids[slot], self._owners[slot])
+
+    async def lookupMany(self, session, ibans):
+        """Entries for the given IBANs that exist, by IBAN; one query for those the directory doesn't hold."""
+        found, missing = {}, []
+        for iban in set(ibans):
+            entry = self.get(iban)
+            if entry is None:
+                missing.append(iban)
+            else:
+                found[iban] = entry
+        directory_lookups.inc(len(found), result="hit")
+        if missing:
+            directory_lookups.inc(len(missing), result="miss")
+            account_query = select(db.Account.iban, db.Account.id, db.Account.userID).where(db.Account.iban.in_(missing))
+            for account in (await session.execute(account_query)).all():
+                self.add(account.iban, account.id, account.userID)
+                found[account.iban] = DirectoryEntry(account.id, account.userID)
+        return found
+
+    async def lookup(self, session, iban: str):
+        return (await self.lookupMany(session, [iban])).get(iban)
+
+    def __len__(self):
+        return len(self._slots)
+
+iban_directory = IbanDirectory()
@@ -0,0 +1,83 @@
+from datetime import datetime, timedelta
+import hashlib
+import json
+import os
+import time
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy import delete
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+import db
+from cache import TTLCache
+
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+IDEMPOTENCY_CACHE_TTL = int(os.getenv("IDEMPOTENCY_CACHE_TTL", "300"))
+IDEMPOTENCY_KEY_TTL = timedelta(hours=int(os.getenv("IDEMPOTENCY_KEY_TTL_HOURS", "24")))
+
+idempotency_cache = TTLCache(IDEMPOTENCY_CACHE_SIZE)
+
+def _inProgress():
+    return JSONResponse(status_code=409, content={"error": "A request with this Idempotency-Key is in progress"})
+
+def _reused():
+    return JSONResponse(status_code=422, content={"error": "Idempotency-Key already used for another request"})
+
+def requestFingerprint(body):
+    canonical = json.dumps(jsonable_encoder(body), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+def _storedResponse(stored: db.IdempotencyKey, route: str, fingerprint: str):
+    if stored.route != route or stored.fingerprint != fingerprint:
+        return _reused()
+    if stored.response is None:
+        return _inProgress()
+    response = json.loads(stored.response)
+    idempotency_cache.set((stored.userID, stored.key), (route, fingerprint, response), time.time() + IDEMPOTENCY_CACHE_TTL)
+    return response
+
+async def idempotentResponse(session: AsyncSession, key: str | None, route: str, body, operation):
+    """Runs operation() once per user and Idempotency-Key and answers retries with its first response.
+
+    Keys are scoped to body.userID, and a retry must send the same body to the
+    same route: anything else is refused rather than answered with a response
+    to a different request. The key row is inserted before the operation, so it
+    is committed together with the deposit or transfer; a concurrent retry hits
+    the primary key and waits for it.
+    """
+    if key is None:
+        return await operation()
+
+    fingerprint = requestFingerprint(body)
+    cached = idempotency_cache.get((body.userID, key))
+    if cached is not None:
+        cached_route, cached_fingerprint, response = cached
+        return response if (cached_route, cached_fingerprint) == (route, fingerprint) else _reused()
+
+    stored = await session.get(db.IdempotencyKey, (body.userID, key))
+    if stored is None:
+        claim = db.IdempotencyKey(userID=body.userID, key=key, route=route, fingerprint=fingerprint)
+        session.add(claim)
+        try:
+            await session.flush()
+        except IntegrityError:
+            await session.rollback()
+            stored = await session.get(db.IdempotencyKey, (body.userID, key))
+            if stored is None:
+                return _inProgress()
+    if stored is not None:
+        return _storedResponse(stored, route, fingerprint)
+
+    response = jsonable_encoder(await operation())
+    claim.response = json.dumps(response)
+    session.add(claim)
+    await session.commit()
+    idempotency_cache.set((body.userID, key), (route, fingerprint, response), time.time() + IDEMPOTENCY_CACHE_TTL)
+    return response
+
+def purgeIdempotencyKeys(session: Session, now: datetime | None = None):
+    cutoff = (now or datetime.utcnow()) - IDEMPOTENCY_KEY_TTL
+    deleted = session.execute(delete(db.IdempotencyKey).where(db.IdempotencyKey.created_at < cutoff)).rowcount
+    session.commit()
+    return deleted
@@ -0,0 +1,74 @@
+from decimal import Decimal
+from sqlalchemy import and_, func, insert, select, type_coerce
+from sqlalchemy.orm import Session
+import db
+from money import MoneyType
+
+def postingEntries(kind: db.LedgerEntryKind, amount: Decimal, referenceID: int | None, creditAccountID: int, debitAccountID: int | None = None):
+    """The two legs moving amount from debitAccountID (None: outside the bank) to creditAccountID."""
+    return [
+        {"accountID": creditAccountID, "amount": amount, "kind": kind, "referenceID": referenceID},
+        {"accountID": debitAccountID, "amount": -amount, "kind": kind, "referenceID": referenceID},
+    ]
+
+def postEntries(session, entries):
+    session.add_all([db.LedgerEntry(**entry) for entry in entries])
+
+def ledgerBalancesQuery(account_ids=None):
+    """Balance of every account replayed from its latest snapshot and the entries after it."""
+    latest = (
+        select(db.BalanceSnapshot.accountID, func.max(db.BalanceSnapshot.id).label("id"))
+        .group_by(db.BalanceSnapshot.accountID)
+        .subquery()
+    )
+    snapshot = (
+        select(db.BalanceSnapshot.accountID, db.BalanceSnapshot.balance, db.BalanceSnapshot.lastEntryID)
+        .join(latest, db.BalanceSnapshot.id == latest.c.id)
+        .subquery()
+    )
+    query = (
+        select(
+            db.Account.id,
+            db.Account.sold,
+            # Summed as integer cents in SQL, read back as Decimal.
+            type_coerce(func.coalesce(snapshot.c.balance, 0) + func.coalesce(func.sum(db.LedgerEntry.amount), 0), MoneyType).label("balance"),
+            func.coalesce(func.max(db.LedgerEntry.id), snapshot.c.lastEntryID, 0).label("lastEntryID")
+        )
+        .outerjoin(snapshot, snapshot.c.accountID == db.Account.id)
+        .outerjoin(db.LedgerEntry, and_(
+            db.LedgerEntry.accountID == db.Account.id,
+            db.LedgerEntry.id > func.coalesce(snapshot.c.lastEntryID, 0)
+        ))
+        .group_by(db.Account.id, db.Account.sold, snapshot.c.balance, snapshot.c.lastEntryID)
+    )
+    if account_ids is not None:
+        query = query.where(db.Account.id.in_(account_ids))
+    return query
+
+def accountBalance(session: Session, account_id: int):
+    row = session.execute(ledgerBalancesQuery([account_id])).first()
+    return row.balance if row else None
+
+def verifyBalances(session: Session):
+    """Accounts whose materialized sold doesn't match the ledger, as (id, sold, ledger balance)."""
+    return [
+        (row.id, row.sold, row.balance)
+        for row in session.execute(ledgerBalancesQuery())
+        if row.sold != row.balance
+    ]
+
+def takeSnapshots(session: Session):
+    """Records the ledger balance of every account that has new entries since its last snapshot."""
+    rows = session.execute(ledgerBalancesQuery()).all()
+    latest = dict(session.execute(
+        select(db.BalanceSnapshot.accountID, func.max(db.BalanceSnapshot.lastEntryID)).group_by(db.BalanceSnapshot.accountID)
+    ).all())
+    snapshots = [
+        {"accountID": row.id, "balance": row.balance, "lastEntryID": row.lastEntryID}
+        for row in rows
+        if row.lastEntryID and row.lastEntryID != latest.get(row.id)
+    ]
+    if snapshots:
+        session.execute(insert(db.BalanceSnapshot), snapshots)
+    session.commit()
+    return len(snapshots)
@@ -0,0 +1,61 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import time
+from metrics import Gauge, Histogram
+
+SCRYPT_N = int(os.getenv("SCRYPT_N", str(2 ** 14)))
+SCRYPT_R = int(os.getenv("SCRYPT_R", "8"))
+SCRYPT_P = int(os.getenv("SCRYPT_P", "1"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+
+# hashlib.scrypt releases the GIL, so a few threads are enough to keep the CPU-heavy
+# work off the event loop while capping how many hashes run at once.
+hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+
+hash_seconds = Histogram("password_hash_seconds", "Time spent hashing or verifying a password", ["operation"])
+hash_queue_depth = Gauge("password_hash_queue_depth", "Password hashes waiting for a worker")
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 1024 * 1024)
+
+def _b64(data: bytes):
+    return base64.b64encode(data).decode()
+
+def hashPassword(password: str):
+    salt = secrets.token_bytes(16)
+    digest = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(digest)}"
+
+def verifyPassword(password: str, stored: str):
+    if not stored.startswith("scrypt$"):
+        # Accounts registered before salted hashing store a bare sha256 hex digest.
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+    _, n, r, p, salt, digest = stored.split("$")
+    candidate = _scrypt(password, base64.b64decode(salt), int(n), int(r), int(p))
+    return hmac.compare_digest(candidate, base64.b64decode(digest))
+
+def needsRehash(stored: str):
+    return not stored.startswith(f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$")
+
+async def _runHashing(operation: str, fn, *args):
+    def timed():
+        hash_queue_depth.dec()
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            hash_seconds.observe(time.perf_counter() - started, operation=operation)
+
+    hash_queue_depth.inc()
+    return await asyncio.get_running_loop().run_in_executor(hash_executor, timed)
+
+async def hashPasswordAsync(password: str):
+    return await _runHashing("hash", hashPassword, password)
+
+async def verifyPasswordAsync(password: str, stored: str):
+    return await _runHashing("verify", verifyPassword, password, stored)
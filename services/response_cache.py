@@ -0,0 +1,106 @@
+"""Read-through cache for the dashboard endpoints, with ETag revalidation.
+
+Entries are tagged with what they were built from ("account:<id>",
+"accounts:<userID>", ...) and dropped with invalidate() when that changes.
+"""
+import hashlib
+import json
+import os
+import time
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from cache import TTLCache
+from metrics import Counter
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "10000"))
+# Bounds staleness across workers with the in-memory backend, see TTLCache.
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "30"))
+RESPONSE_CACHE_URL = os.getenv("RESPONSE_CACHE_URL", "")
+
+cache_requests = Counter("response_cache_requests_total", "Cacheable requests by whether the response was cached", ["route", "result"])
+cache_not_modified = Counter("response_cache_not_modified_total", "Requests answered 304 because the client's ETag was current", ["route"])
+
+class MemoryBackend:
+    def __init__(self, max_size: int = RESPONSE_CACHE_SIZE):
+        self.entries = TTLCache(max_size)
+
+    def get(self, key: str):
+        return self.entries.get(key)
+
+    def set(self, key: str, value, ttl: int, tags):
+        self.entries.set(key, value, time.time() + ttl, tags)
+
+    def invalidate(self, tags):
+        for tag in tags:
+            self.entries.invalidate_tag(tag)
+
+    def clear(self):
+        self.entries.clear()
+
+class RedisBackend:
+    """Shares entries between workers through a Redis-compatible server (needs the redis package)."""
+    prefix = "response:"
+
+    def __init__(self, url: str):
+        import redis
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key: str):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else tuple(json.loads(value))
+
+    def set(self, key: str, value, ttl: int, tags):
+        pipeline = self.client.pipeline()
+        pipeline.set(self.prefix + key, json.dumps(value), ex=ttl)
+        for tag in tags:
+            pipeline.sadd(self.prefix + "tag:" + tag, key)
+            pipeline.expire(self.prefix + "tag:" + tag, ttl)
+        pipeline.execute()
+
+    def invalidate(self, tags):
+        for tag in tags:
+            tag_key = self.prefix + "tag:" + tag
+            keys = [self.prefix + key.decode() for key in self.client.smembers(tag_key)]
+            self.client.delete(tag_key, *keys)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+backend = RedisBackend(RESPONSE_CACHE_URL) if RESPONSE_CACHE_URL else MemoryBackend()
+
+def invalidate(*tags: str):
+    backend.invalidate(tags)
+
+def invalidateAccounts(account_ids):
+    invalidate(*[f"account:{account_id}" for account_id in account_ids])
+
+def _entityTag(body: str):
+    return '"' + hashlib.sha256(body.encode()).hexdigest()[:32] + '"'
+
+async def cachedResponse(request: Request, key: str, load):
+    """Serves key from the cache, or from load() which returns (content, tags).
+
+    Responses built with tags=None (errors) are served but not cached. Either
+    way the response carries an ETag, and a request whose If-None-Match still
+    matches gets an empty 304.
+    """
+    route = request.scope["route"].path
+    entry = backend.get(key)
+    if entry is None:
+        cache_requests.inc(route=route, result="miss")
+        content, tags = await load()
+        body = json.dumps(jsonable_encoder(content))
+        entry = (_entityTag(body), body)
+        if tags is not None:
+            backend.set(key, entry, RESPONSE_CACHE_TTL, tags)
+    else:
+        cache_requests.inc(route=route, result="hit")
+
+    etag, body = entry
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        cache_not_modified.inc(route=route)
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
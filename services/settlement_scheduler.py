@@ -0,0 +1,113 @@
+from datetime import datetime, timedelta
+import heapq
+import os
+import threading
+from sqlalchemy import select
+import db
+from metrics import Gauge, Histogram
+from .settlement_service import SETTLEMENT_BATCH_SIZE, SETTLEMENT_DELAY, settleTransfers
+
+SETTLEMENT_RETRY_DELAY = timedelta(seconds=float(os.getenv("SETTLEMENT_RETRY_SECONDS", "5")))
+# Transfers created by other processes, and leases left by a crashed worker, are
+# only seen by looking at the database; do so at least this often.
+SETTLEMENT_RESCAN_DELAY = timedelta(seconds=float(os.getenv("SETTLEMENT_RESCAN_SECONDS", "30")))
+
+settlement_queue_depth = Gauge("settlement_queue_depth", "Transfers waiting for their settlement time")
+settlement_lag_seconds = Histogram("settlement_lag_seconds", "Time between a transfer falling due and its settlement starting")
+
+class SettlementScheduler:
+    """Wakes a settlement worker when the next pending transfer falls due.
+
+    Due times are kept in a heap filled from the database on start and fed by
+    schedule() as transfers are created. The worker thread sleeps until the
+    earliest one, or at most SETTLEMENT_RESCAN_DELAY, then settles everything
+    due in bounded batches.
+    """
+
+    def __init__(self, session_factory=db.create_session, clock=datetime.utcnow, batch_size: int = SETTLEMENT_BATCH_SIZE):
+        self.session_factory = session_factory
+        self.clock = clock
+        self.batch_size = batch_size
+        self._heap = []
+        self._rescan_at = None
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._rescan_at = self.clock() + SETTLEMENT_RESCAN_DELAY
+            self._thread = threading.Thread(target=self._run, name="settlement", daemon=True)
+        # Transfers created from here on are scheduled directly, so none is missed between the load and the start.
+        with self.session_factory() as session:
+            pending_query = select(db.Transfer.id, db.Transfer.created_at).where(db.Transfer.status == db.TransferStatus.PENDING)
+            pending = session.execute(pending_query).all()
+        with self._condition:
+            for transfer in pending:
+                heapq.heappush(self._heap, (transfer.created_at + SETTLEMENT_DELAY, transfer.id))
+            settlement_queue_depth.set(len(self._heap))
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            thread, self._thread = self._thread, None
+            self._stopping = True
+            self._heap.clear()
+            settlement_queue_depth.set(0)
+            self._condition.notify()
+        if thread is not None and thread.is_alive():
+            thread.join()
+
+    def schedule(self, transfer_id: int, created_at: datetime):
+        with self._condition:
+            if self._thread is None:
+                return
+            entry = (created_at + SETTLEMENT_DELAY, transfer_id)
+            heapq.heappush(self._heap, entry)
+            settlement_queue_depth.set(len(self._heap))
+            if self._heap[0] is entry:
+                # Only a new earliest due time changes how long the worker should sleep.
+                self._condition.notify()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _takeDue(self):
+        """Blocks until transfers are due or a rescan is, and pops the due ones; returns None once stopped."""
+        with self._condition:
+            while not self._stopping:
+                now = self.clock()
+                wake_at = min(self._heap[0][0], self._rescan_at) if self._heap else self._rescan_at
+                if wake_at <= now:
+                    self._rescan_at = now + SETTLEMENT_RESCAN_DELAY
+                    due = []
+                    while self._heap and self._heap[0][0] <= now:
+                        due.append(heapq.heappop(self._heap))
+                    settlement_queue_depth.set(len(self._heap))
+                    return now, due
+                self._condition.wait((wake_at - now).total_seconds())
+            return None
+
+    def _run(self):
+        while (taken := self._takeDue()) is not None:
+            now, due = taken
+            if due:
+                settlement_lag_seconds.observe((now - due[0][0]).total_seconds())
+            try:
+                with self.session_factory() as session:
+                    result = settleTransfers(session, now=now, batch_size=self.batch_size)
+            except Exception as error:
+                print(f"Settlement failed, retrying in {SETTLEMENT_RETRY_DELAY.total_seconds():g}s: {error}")
+                retry_at = self.clock() + SETTLEMENT_RETRY_DELAY
+                with self._condition:
+                    for _, transfer_id in due:
+                        heapq.heappush(self._heap, (retry_at, transfer_id))
+                    settlement_queue_depth.set(len(self._heap))
+                continue
+            if due or result.settled or result.cancelled:
+                print(f"Settled {result.settled} and cancelled {result.cancelled} transfers in {result.duration * 1000:.1f} ms")
+
+settlement_scheduler = SettlementScheduler()
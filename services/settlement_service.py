@@ -0,0 +1,213 @@
+from datetime import datetime, timedelta
+from typing import NamedTuple
+import os
+import socket
+import time
+from sqlalchemy import bindparam, insert, or_, select, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+import db
+from metrics import Counter, Histogram
+from money import MoneyType
+from .activity_service import activityRows, activityUpsert, transferSettledActivity
+from .event_bus import event_bus, publishBalance, transferEvent
+from .ledger_service import postingEntries
+from .response_cache import invalidateAccounts
+
+SETTLEMENT_DELAY = timedelta(seconds=10)
+SETTLEMENT_BATCH_SIZE = 500
+SETTLEMENT_RETRIES = 5
+SETTLEMENT_LEASE = timedelta(seconds=float(os.getenv("SETTLEMENT_LEASE_SECONDS", "60")))
+WORKER_ID = os.getenv("SETTLEMENT_WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+
+account_table = db.Account.__table__
+# Adds a net delta to one balance and refuses to take it below zero, whatever
+# deposits or other settlements committed since the batch read it. What the
+# settled transfers had reserved on the account is released in the same update.
+guarded_balance_update = (
+    update(account_table)
+    .where(account_table.c.id == bindparam("account_id"), account_table.c.sold >= bindparam("floor", type_=MoneyType))
+    .values(
+        sold=account_table.c.sold + bindparam("delta", type_=MoneyType),
+        reserved=account_table.c.reserved - bindparam("released", type_=MoneyType),
+    )
+)
+
+settlement_batch_size = Histogram("settlement_batch_size", "Transfers claimed per settlement batch", buckets=(1, 10, 50, 100, 250, 500, 1000, 5000))
+settlement_batch_seconds = Histogram("settlement_batch_duration_seconds", "Time to claim and settle one batch")
+settlement_transfers = Counter("settlement_transfers_total", "Settled transfers, by whether the source could cover them", ["result"])
+
+class BalanceConflict(Exception):
+    pass
+
+class SettlementResult(NamedTuple):
+    settled: int
+    cancelled: int
+    duration: float
+
+class BatchResult(NamedTuple):
+    claimed: int
+    settled: int
+    cancelled: int
+
+def applyTransfers(balances: dict, transfers):
+    """Moves money between the loaded balances, in order, skipping transfers the source can't cover.
+
+    Returns the transfers that moved money.
+    """
+    moved = []
+    for transfer in transfers:
+        source = balances.get(transfer.sourceAccountID)
+        if source is None or transfer.targetAccountID not in balances:
+            continue
+        if source >= transfer.sold:
+            balances[transfer.sourceAccountID] -= transfer.sold
+            balances[transfer.targetAccountID] += transfer.sold
+            moved.append(transfer)
+    return moved
+
+def applyBalanceDeltas(session: Session, deltas: dict, released: dict | None = None):
+    released = released or {}
+    params = [
+        {"account_id": account_id, "delta": deltas.get(account_id, 0), "floor": -deltas.get(account_id, 0), "released": released.get(account_id, 0)}
+        for account_id in deltas.keys() | released.keys()
+        if deltas.get(account_id) or released.get(account_id)
+    ]
+    if params and session.execute(guarded_balance_update, params).rowcount != len(params):
+        raise BalanceConflict("a balance changed under the settlement batch")
+
+def claimTransfers(session: Session, worker: str, due_before: datetime, now: datetime, batch_size: int = SETTLEMENT_BATCH_SIZE):
+    """Leases up to batch_size due transfers to worker and commits, so other workers skip them.
+
+    Transfers whose lease expired (their worker died mid-batch) can be claimed again,
+    and so can the worker's own claims left by a failed batch.
+    """
+    due = (
+        select(db.Transfer.id)
+        .where(
+            db.Transfer.status == db.TransferStatus.PENDING,
+            db.Transfer.created_at <= due_before,
+            or_(db.Transfer.claimExpiresAt.is_(None), db.Transfer.claimExpiresAt <= now, db.Transfer.claimedBy == worker),
+        )
+        .order_by(db.Transfer.created_at, db.Transfer.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    claim = (
+        update(db.Transfer)
+        .where(db.Transfer.id.in_(due.scalar_subquery()))
+        .values(claimedBy=worker, claimExpiresAt=now + SETTLEMENT_LEASE)
+        .returning(db.Transfer.id)
+        .execution_options(synchronize_session=False)
+    )
+    claimed = session.scalars(claim).all()
+    session.commit()
+    return claimed
+
+def completeClaimed(session: Session, worker: str, transfer_ids):
+    """Moves the money of the claimed transfers this worker still holds and marks them completed, in one transaction.
+
+    Returns how many moved money and how many were cancelled, because their source couldn't cover them
+    or their target account was closed by the time they settled.
+    """
+    # Marking them first takes the rows: a transfer another worker re-claimed
+    # and completed after our lease expired is simply not returned.
+    complete = (
+        update(db.Transfer)
+        .where(db.Transfer.id.in_(transfer_ids), db.Transfer.claimedBy == worker, db.Transfer.status == db.TransferStatus.PENDING)
+        .values(status=db.TransferStatus.COMPLETED, claimedBy=None, claimExpiresAt=None)
+        .returning(db.Transfer.id, db.Transfer.sold, db.Transfer.sourceAccountID, db.Transfer.targetAccountID, db.Transfer.created_at)
+        .execution_options(synchronize_session=False)
+    )
+    transfers = sorted(session.execute(complete).all(), key=lambda t: (t.created_at, t.id))
+    if not transfers:
+        session.commit()
+        return 0, 0
+
+    account_ids = {t.sourceAccountID for t in transfers} | {t.targetAccountID for t in transfers}
+    account_query = select(db.Account.id, db.Account.sold, db.Account.userID, db.Account.isClosed).where(db.Account.id.in_(account_ids))
+    accounts = session.execute(account_query).all()
+    balances = {row.id: row.sold for row in accounts}
+    owners = {row.id: row.userID for row in accounts}
+    closed = {row.id for row in accounts if row.isClosed}
+    initial = dict(balances)
+
+    # A closed account takes no money, even if another worker closed it after the transfer was accepted.
+    moved = applyTransfers(balances, [t for t in transfers if t.targetAccountID not in closed])
+    moved_ids = {t.id for t in moved}
+    settled_on = datetime.utcnow().date()
+    activity = [
+        change
+        for t in transfers
+        for change in transferSettledActivity(t.sourceAccountID, t.targetAccountID, t.created_at.date(), settled_on, t.sold, t.id in moved_ids)
+    ]
+
+    deltas = {account_id: sold - initial[account_id] for account_id, sold in balances.items()}
+    released = {}
+    for t in transfers:
+        released[t.sourceAccountID] = released.get(t.sourceAccountID, 0) + t.sold
+    applyBalanceDeltas(session, deltas, released)
+    skipped = [t.id for t in transfers if t.id not in moved_ids]
+    if skipped:
+        # Transfers to a closed account, or created before reservations existed and short of funds; they moved nothing.
+        cancel = update(db.Transfer).where(db.Transfer.id.in_(skipped)).values(status=db.TransferStatus.CANCELLED)
+        session.execute(cancel.execution_options(synchronize_session=False))
+    if moved:
+        entries = [
+            entry
+            for t in moved
+            for entry in postingEntries(db.LedgerEntryKind.TRANSFER, t.sold, t.id, t.targetAccountID, t.sourceAccountID)
+        ]
+        session.execute(insert(db.LedgerEntry), entries)
+    session.execute(activityUpsert(), activityRows(activity))
+    changed = [account_id for account_id, delta in deltas.items() if delta]
+    settled_balances = []
+    if len(event_bus) and changed:
+        # Deposits may have landed since the batch read the balances: publish what the update left.
+        settled_balances = session.execute(select(db.Account.id, db.Account.sold).where(db.Account.id.in_(changed))).all()
+    session.commit()
+    invalidateAccounts(changed)
+    if len(event_bus):
+        for t in transfers:
+            status = db.TransferStatus.COMPLETED if t.id in moved_ids else db.TransferStatus.CANCELLED
+            event = transferEvent(t.id, status, t.sold, t.sourceAccountID, t.targetAccountID)
+            event_bus.publish(event, {owners[t.sourceAccountID], owners[t.targetAccountID]}, {t.sourceAccountID, t.targetAccountID})
+        for account in settled_balances:
+            publishBalance(account.id, owners[account.id], account.sold)
+    settlement_transfers.inc(len(moved), result="moved")
+    settlement_transfers.inc(len(skipped), result="skipped")
+    return len(moved), len(skipped)
+
+def settleBatch(session: Session, due_before: datetime, batch_size: int = SETTLEMENT_BATCH_SIZE, worker: str = WORKER_ID, now: datetime | None = None):
+    """Claims one batch and settles it; if a concurrent writer drained an account in the meantime, re-reads and tries again.
+
+    Returns how many transfers were claimed, and of those how many moved money and how many were cancelled.
+    """
+    started = time.perf_counter()
+    claimed = claimTransfers(session, worker, due_before, now or datetime.utcnow(), batch_size)
+    if not claimed:
+        return BatchResult(0, 0, 0)
+    for attempt in range(SETTLEMENT_RETRIES):
+        try:
+            settled, cancelled = completeClaimed(session, worker, claimed)
+            settlement_batch_size.observe(len(claimed))
+            settlement_batch_seconds.observe(time.perf_counter() - started)
+            return BatchResult(len(claimed), settled, cancelled)
+        except (BalanceConflict, OperationalError):
+            session.rollback()
+            if attempt == SETTLEMENT_RETRIES - 1:
+                raise
+
+def settleTransfers(session: Session, now: datetime | None = None, batch_size: int = SETTLEMENT_BATCH_SIZE, worker: str = WORKER_ID):
+    """Settles every due transfer, one bounded batch per transaction."""
+    started = time.perf_counter()
+    now = now or datetime.utcnow()
+    due_before = now - SETTLEMENT_DELAY
+    settled = cancelled = 0
+    while True:
+        batch = settleBatch(session, due_before, batch_size, worker, now)
+        settled += batch.settled
+        cancelled += batch.cancelled
+        if batch.claimed < batch_size:
+            break
+    return SettlementResult(settled, cancelled, time.perf_counter() - started)
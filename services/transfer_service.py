@@ -1,24 +1,118 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, insert, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
 import db
-from .account_service import getAccount
+from datetime import datetime
+from decimal import Decimal
+from .account_service import reserveFunds
+from .activity_service import activityRows, activityUpsert, transferCreatedActivity
+from .event_bus import event_bus, publishTransfer, transferEvent
+from .iban_directory import iban_directory
+from .settlement_scheduler import settlement_scheduler
 
-def isTransferPossible(amount: float, firstAccount: db.Account):
-    return firstAccount.sold > 0 and amount <= firstAccount.sold and amount > 0
+def availableBalance(account: db.Account):
+    return account.sold - account.reserved
 
-def transferMoney(session: Session, amount: float, sourceAccount: db.Account, targetIban: str):
+def isTransferPossible(amount: Decimal, firstAccount: db.Account):
+    available = availableBalance(firstAccount)
+    return available > 0 and amount <= available and amount > 0
+
+async def transferMoney(session: AsyncSession, amount: Decimal, sourceAccount: db.Account, targetIban: str, targetAccount=None):
+    """Creates a pending transfer; pass targetAccount (an Account or a directory entry) when the caller already resolved it."""
     if sourceAccount.iban == targetIban:
         return "error : Invalid transfer, the accounts are the same"
     if amount <= 0:
         return "error : Invalid amount, must be superior to 0"
 
-    targetAccount = getAccount(session, targetIban)
+    if targetAccount is None:
+        targetAccount = await iban_directory.lookup(session, targetIban)
     if targetAccount is None:
         return "error : This IBAN does not exist"
     
-    if isTransferPossible(amount, sourceAccount):
-        transferData = db.Transfer(sold=amount, userID=sourceAccount.userID, sourceAccountID=sourceAccount.id, targetAccountID=targetAccount.id)
-        session.add(transferData)
-        session.commit()
-        return "Transfer done"
-    else:
-        return "error : This account isn't sold enough to make the transfer"
\ No newline at end of file
+    # The reservation is the authoritative check: another request may have reserved since the account was read.
+    if not isTransferPossible(amount, sourceAccount) or not (await session.scalars(reserveFunds({sourceAccount.id: amount}))).all():
+        return "error : This account isn't sold enough to make the transfer"
+
+    transferData = db.Transfer(sold=amount, userID=sourceAccount.userID, sourceAccountID=sourceAccount.id, targetAccountID=targetAccount.id)
+    session.add(transferData)
+    await session.execute(activityUpsert(), activityRows(transferCreatedActivity(sourceAccount.id, transferData.created_at.date(), amount)))
+    await session.commit()
+    settlement_scheduler.schedule(transferData.id, transferData.created_at)
+    publishTransfer(transferData.id, db.TransferStatus.PENDING, amount, sourceAccount, targetAccount)
+    return "Transfer done"
+
+async def transferMoneyBatch(session: AsyncSession, userID: int, transfers):
+    """Validates a list of transfers against each other and inserts the accepted ones together.
+
+    Target IBANs are resolved through the directory, then the source accounts and
+    the targets' closed flags are loaded in one query. Balances are checked against what earlier items of the batch already took from the
+    account, then each source reserves its accepted total in a single update.
+    """
+    names = {transfer.name for transfer in transfers}
+    ibans = {transfer.iban for transfer in transfers}
+    targets = await iban_directory.lookupMany(session, ibans)
+    target_ids = {target.id for target in targets.values()}
+    account_query = select(db.Account).where(or_(and_(db.Account.userID == userID, db.Account.name.in_(names)), db.Account.id.in_(target_ids)))
+    accounts = (await session.scalars(account_query)).all()
+    sources = {account.name: account for account in accounts if account.userID == userID and account.name in names}
+    closed = {account.id for account in accounts if account.isClosed}
+
+    available = {}
+    results, accepted = [], []
+    created_at = datetime.utcnow()
+    for index, transfer in enumerate(transfers):
+        source = sources.get(transfer.name)
+        target = targets.get(transfer.iban)
+        error = None
+        if source is None:
+            error = "Account not found"
+        elif source.isClosed:
+            error = "Invalid transfer, the source account is closed"
+        elif target is None:
+            error = "This IBAN does not exist"
+        elif target.id in closed:
+            error = "Invalid transfer, the target account is closed"
+        elif source.id == target.id:
+            error = "Invalid transfer, the accounts are the same"
+        elif transfer.sold <= 0:
+            error = "Invalid amount, must be superior to 0"
+        elif transfer.sold > available.setdefault(source.id, availableBalance(source)):
+            error = "This account isn't sold enough to make the transfer"
+
+        result = {"index": index}
+        results.append(result)
+        if error:
+            result["error"] = error
+            continue
+        available[source.id] -= transfer.sold
+        result["message"] = "Transfer done"
+        row = {"sold": transfer.sold, "userID": userID, "sourceAccountID": source.id, "targetAccountID": target.id, "created_at": created_at}
+        accepted.append((result, row))
+
+    if accepted:
+        totals = {}
+        for _, row in accepted:
+            totals[row["sourceAccountID"]] = totals.get(row["sourceAccountID"], 0) + row["sold"]
+        reserved = set((await session.scalars(reserveFunds(totals))).all())
+        if len(reserved) < len(totals):
+            # Another request reserved on these sources since they were read: refuse their items rather than overcommit.
+            for result, row in accepted:
+                if row["sourceAccountID"] not in reserved:
+                    del result["message"]
+                    result["error"] = "This account isn't sold enough to make the transfer"
+            accepted = [(result, row) for result, row in accepted if row["sourceAccountID"] in reserved]
+
+    if accepted:
+        rows = [row for _, row in accepted]
+        # batchSentinel lets SQLAlchemy return the ids in the order of rows from a single INSERT.
+        insert_query = insert(db.Transfer).returning(db.Transfer.id, sort_by_parameter_order=True)
+        ids = (await session.scalars(insert_query, rows)).all()
+        activity = [change for row in rows for change in transferCreatedActivity(row["sourceAccountID"], created_at.date(), row["sold"])]
+        await session.execute(activityUpsert(), activityRows(activity))
+        await session.commit()
+        owners = {source.id: userID for source in sources.values()} | {target.id: target.userID for target in targets.values()}
+        for (result, row), transfer_id in zip(accepted, ids):
+            result["transferID"] = transfer_id
+            settlement_scheduler.schedule(transfer_id, created_at)
+            event = transferEvent(transfer_id, db.TransferStatus.PENDING, row["sold"], row["sourceAccountID"], row["targetAccountID"])
+            event_bus.publish(event, {userID, owners[row["targetAccountID"]]}, {row["sourceAccountID"], row["targetAccountID"]})
+    return results
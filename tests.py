@@ -1,12 +1,43 @@
 import pytest
+import asyncio
+import hashlib
+import json
+import random
+import time
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from fastapi.testclient import TestClient
+from sqlalchemy import event, func, or_, select, update
 from sqlmodel import SQLModel, create_engine, Session
+from datetime import datetime, timedelta
 from main import app
+from iban import IbanAllocator, isValidIban
+from money import fromCents
+import db
+import migrations
+import utils
+from services import addMoney, idempotency_service, password_service, response_cache
+from services.response_cache import cache_requests
+from services.iban_directory import IbanDirectory, iban_directory
+from services.activity_service import activityRange, summarize
+from services import archive_service
+from services.archive_service import ARCHIVE_AFTER, archiveHistory
+from services.event_bus import balanceEvent, event_bus
+from routes.events import eventStream
+import instrumentation
+from instrumentation import request_queries
+from fastapi.routing import APIRoute
+from services.ledger_service import accountBalance, postEntries, postingEntries, takeSnapshots, verifyBalances
+from services.settlement_scheduler import settlement_lag_seconds, settlement_scheduler
+from services.settlement_service import SETTLEMENT_DELAY, SETTLEMENT_LEASE, claimTransfers, settleTransfers
 
 engine = create_engine("sqlite:///database.db", connect_args={"check_same_thread": False})
 SQLModel.metadata.drop_all(engine)
 SQLModel.metadata.create_all(engine)
 
+# Every request of the suite must stay within its route's @queryBudget.
+instrumentation.ENFORCE_QUERY_BUDGETS = True
 client = TestClient(app)
 
 """
@@ -26,6 +57,28 @@ def test_auth_login():
     assert json_response["access_token"] is not None
     assert json_response["token_type"] == "bearer"
         
+def test_auth_password_is_salted():
+    with db.create_session() as session:
+        stored = session.get(db.User, 1).password
+    assert stored.startswith("scrypt$")
+    assert client.post("/auth/login", json={ "email": "test@example.com", "password": "wrongpassword" }).json() == {"error": "Invalid credentials"}
+    assert password_service.hash_seconds.count(operation="verify") > 0
+    assert password_service.hash_queue_depth.value() == 0
+
+def test_auth_me_cached():
+    token = client.post("/auth/login", json={ "email": "test@example.com", "password": "thisisatest" }).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    utils.principal_cache.clear()
+    hits = utils.principal_cache.hits
+
+    assert client.get("/auth/me", headers=headers).json() == { "id": 1, "name": "test", "email": "test@example.com" }
+    assert client.get("/auth/me", headers=headers).json()["id"] == 1
+    assert utils.principal_cache.hits == hits + 1
+
+    utils.invalidate_user(1)
+    assert len(utils.principal_cache) == 0
+    assert client.get("/auth/me", headers={"Authorization": "Bearer nope"}).status_code == 401
+
 def test_get_user():
     response = client.get("/users/1")
     assert response.status_code == 200
@@ -53,6 +106,28 @@ def test_account_deposit():
     assert response.status_code == 200
     assert response.json() == {'message': ['Money added successfully to account']}
     
+def test_account_deposit_idempotent():
+    headers = {"Idempotency-Key": "deposit-retry-1"}
+    first = client.post("/account/deposit", json={ "name": "Missing", "userID": 1, "sold": 100 }, headers=headers)
+    assert first.json() == {"error": "Account not found"}
+    client.post("/account/create", json={"name": "Retry", "userID": 1})
+    headers = {"Idempotency-Key": "deposit-retry-2"}
+    first = client.post("/account/deposit", json={ "name": "Retry", "userID": 1, "sold": 25 }, headers=headers)
+    idempotency_service.idempotency_cache.clear()
+    second = client.post("/account/deposit", json={ "name": "Retry", "userID": 1, "sold": 25 }, headers=headers)
+    third = client.post("/account/deposit", json={ "name": "Retry", "userID": 1, "sold": 25 }, headers=headers)
+    assert first.json() == second.json() == third.json() == {'message': ['Money added successfully to account']}
+    assert client.post("/account/infos", json={ "name": "Retry", "userID": 1 }).json()["sold"] == 25
+
+    other_route = client.post("/account/transfer", json={ "sold": 1, "name": "Retry", "iban": "x", "userID": 1 }, headers=headers)
+    assert other_route.status_code == 422
+    other_body = client.post("/account/deposit", json={ "name": "Retry", "userID": 1, "sold": 30 }, headers=headers)
+    assert other_body.status_code == 422
+    # Another user's key of the same name is theirs: it runs, and never sees the first user's response.
+    other_user = client.post("/account/deposit", json={ "name": "Retry", "userID": 2, "sold": 25 }, headers=headers)
+    assert other_user.json() == {"error": "Account not found"}
+    assert client.post("/account/infos", json={ "name": "Retry", "userID": 1 }).json()["sold"] == 25
+
 def test_account_deposit_logs():
     response = client.post("/account/deposit_logs", json={ "name": "Test", "userID": 1 })
     assert response.status_code == 200
@@ -74,6 +149,12 @@ def test_account_close():
     assert response.status_code == 200
     assert response.json() == {"message": "Account closed"}
 
+def test_sync_session_mode(monkeypatch):
+    monkeypatch.setattr(db, "USE_ASYNC_DB", False)
+    response = client.post("/account/infos", json={ "name": "Test", "userID": 1 })
+    assert response.status_code == 200
+    assert response.json()["sold"] == 100
+
 """
 Transfer tests
 """
@@ -92,6 +173,41 @@ def test_transaction_logs():
     assert json_response["account_name"] == "Test"
     assert json_response["transactions"] is not None
 
+def test_transaction_logs_pages():
+    first_page = client.post("/account/transaction_logs", json={ "name": "Test", "userID": 1 }).json()
+    expected = first_page["transactions"]
+    assert first_page["next_cursor"] is None
+
+    paged, cursor = [], None
+    while True:
+        page = client.post("/account/transaction_logs", json={ "name": "Test", "userID": 1, "limit": 1, "cursor": cursor }).json()
+        paged += page["transactions"]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert paged == expected
+    assert len(paged) == 2
+
+    deposits = client.post("/account/transaction_logs", json={ "name": "Test", "userID": 1, "type": "deposit" }).json()
+    assert [log["type"] for log in deposits["transactions"]] == ["deposit"]
+
+def test_transaction_logs_invalid_cursor():
+    response = client.post("/account/transaction_logs", json={ "name": "Test", "userID": 1, "cursor": "nope" })
+    assert response.json() == {"error": "Invalid cursor"}
+
+def test_statements_export():
+    response = client.post("/account/statements/export", json={ "userID": 1 })
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    test_rows = [row for row in rows if row["account_name"] == "Test"]
+    assert [row["type"] for row in test_rows] == ["deposit", "transfer"]
+
+    response = client.post("/account/statements/export", json={ "userID": 1, "format": "csv" })
+    lines = response.text.splitlines()
+    assert lines[0] == "account_iban,account_name,id,type,amount,date,from_account,to_account,status"
+    assert len(lines) == len(rows) + 1
+
 def test_transfer_cancelled():
     last_transfer_id = client.post("/transfer/last").json()["id"]
     response = client.post("/transfer/canceled", json={ "userID": 1, "transferID": last_transfer_id })
@@ -109,6 +225,182 @@ def test_transfer_info():
     assert json_response["target_account"] is not "Unknown"
     assert json_response["status"] == "cancelled"
 
+def test_settle_transfers():
+    test_account = client.post("/account/infos", json={ "name": "Test", "userID": 1 }).json()
+    client.post("/account/transfer", json={ "sold": 30, "name": "Principal", "iban": test_account["iban"], "userID": 1 })
+    # The 30 still pending is reserved, so 80 more would overcommit the 100 on the account.
+    response = client.post("/account/transfer", json={ "sold": 80, "name": "Principal", "iban": test_account["iban"], "userID": 1 })
+    assert response.json() == {"message": ["error : This account isn't sold enough to make the transfer"]}
+    with db.create_session() as session:
+        assert session.scalars(select(db.Account.reserved).where(db.Account.userID == 1, db.Account.name == "Principal")).one() == 30
+        result = settleTransfers(session, now=datetime.utcnow() + timedelta(seconds=11))
+    assert result.settled == 1
+
+    assert client.post("/account/infos", json={ "name": "Principal", "userID": 1 }).json()["sold"] == 70
+    assert client.post("/account/infos", json={ "name": "Test", "userID": 1 }).json()["sold"] == 130
+
+    # A transfer from before reservations that the source can't cover is cancelled, not reported as settled.
+    with db.create_session() as session:
+        source, target = session.scalars(select(db.Account).where(db.Account.userID == 1, db.Account.name.in_(["Test", "Principal"])).order_by(db.Account.name.desc())).all()
+        source.reserved += 1000
+        session.add(db.Transfer(sold=1000, userID=1, sourceAccountID=source.id, targetAccountID=target.id, created_at=datetime.utcnow() - timedelta(minutes=1)))
+        session.commit()
+        result = settleTransfers(session, now=datetime.utcnow() + timedelta(seconds=11))
+    assert (result.settled, result.cancelled) == (0, 1)
+    assert client.post("/account/infos", json={ "name": "Test", "userID": 1 }).json()["sold"] == 130
+
+def test_settlement_conserves_money():
+    rng = random.Random(1337)
+    client.post("/auth/register", json={ "name": "conserve", "email": "conserve@example.com", "password": "thisisconserved" })
+    with db.create_session() as session:
+        user_id = session.scalars(select(db.User.id).where(db.User.email == "conserve@example.com")).one()
+    names = ["Principal"] + [f"Pot {i}" for i in range(4)]
+    ibans = {}
+    for name in names:
+        if name != "Principal":
+            client.post("/account/create", json={ "name": name, "userID": user_id })
+        client.post("/account/deposit", json={ "name": name, "userID": user_id, "sold": str(fromCents(rng.randrange(1, 10_000))) })
+        ibans[name] = client.post("/account/infos", json={ "name": name, "userID": user_id }).json()["iban"]
+
+    def totals(session):
+        sold = session.scalar(select(func.sum(db.Account.sold)))
+        ledger = session.scalar(select(func.sum(db.LedgerEntry.amount)).where(db.LedgerEntry.accountID.is_not(None)))
+        return sold, ledger
+
+    with db.create_session() as session:
+        before = totals(session)
+    for _ in range(200):
+        source, target = rng.sample(names, 2)
+        amount = str(fromCents(rng.randrange(1, 5_000)))
+        client.post("/account/transfer", json={ "name": source, "userID": user_id, "sold": amount, "iban": ibans[target] })
+    with db.create_session() as session:
+        assert settleTransfers(session, now=datetime.utcnow() + SETTLEMENT_DELAY + timedelta(seconds=1)).settled > 0
+        after = totals(session)
+        assert after == before and after[0] == after[1]
+        assert min(session.scalars(select(db.Account.sold).where(db.Account.userID == user_id))) >= 0
+        assert verifyBalances(session) == []
+
+def test_iban_allocation():
+    first, second = IbanAllocator(db.engine, block_size=10), IbanAllocator(db.engine, block_size=10)
+    ibans = first.allocateMany(25) + second.allocateMany(25) + [first.allocate() for _ in range(10)]
+    assert len(set(ibans)) == len(ibans)
+    assert all(isValidIban(iban) for iban in ibans)
+    account_iban = client.post("/account/infos", json={ "name": "Test", "userID": 1 }).json()["iban"]
+    assert isValidIban(account_iban)
+    assert account_iban not in ibans
+
+def test_money_is_exact():
+    client.post("/account/create", json={"name": "Cents", "userID": 1})
+    for _ in range(10):
+        client.post("/account/deposit", json={ "name": "Cents", "userID": 1, "sold": "0.10" })
+    assert client.post("/account/infos", json={ "name": "Cents", "userID": 1 }).json()["sold"] == 1
+    response = client.post("/account/deposit", json={ "name": "Cents", "userID": 1, "sold": 0.001 })
+    assert response.status_code == 422
+
+def test_account_responses_cached():
+    body = { "name": "Cents", "userID": 1 }
+    first = client.post("/account/infos", json=body)
+    hits = cache_requests.value(route="/account/infos", result="hit")
+    assert client.post("/account/infos", json=body).json() == first.json()
+    assert cache_requests.value(route="/account/infos", result="hit") == hits + 1
+    not_modified = client.post("/account/infos", json=body, headers={ "If-None-Match": first.headers["ETag"] })
+    assert not_modified.status_code == 304
+
+    listed = client.post("/accounts/", json={ "userID": 1 })
+    client.post("/account/deposit", json={ "name": "Cents", "userID": 1, "sold": 1 })
+    changed = client.post("/account/infos", json=body, headers={ "If-None-Match": first.headers["ETag"] })
+    assert changed.status_code == 200
+    assert changed.json()["sold"] == 2
+    relisted = client.post("/accounts/", json={ "userID": 1 }, headers={ "If-None-Match": listed.headers["ETag"] })
+    assert [account["sold"] for account in relisted.json()["accounts"] if account["name"] == "Cents"] == [2]
+
+    user = client.get("/users/1")
+    assert user.json() == { "email": "test@example.com", "name": "test" }
+    assert client.get("/users/1", headers={ "If-None-Match": user.headers["ETag"] }).status_code == 304
+
+def test_metrics_endpoint():
+    client.post("/account/infos", json={ "name": "Missing", "userID": 1 })
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    lines = response.text.splitlines()
+    assert "# TYPE http_request_duration_seconds histogram" in lines
+    assert any(line.startswith('http_requests_total{method="POST",route="/account/infos",status="200"} ') for line in lines)
+    assert any(line.startswith('http_request_queries_count{route="/account/infos"} ') for line in lines)
+    assert any(line.startswith('settlement_batch_size_count ') for line in lines)
+
+def test_ledger_matches_balances():
+    with db.create_session() as session:
+        assert verifyBalances(session) == []
+        assert takeSnapshots(session) > 0
+        assert takeSnapshots(session) == 0
+
+    client.post("/account/deposit", json={ "name": "Test", "userID": 1, "sold": 5 })
+    with db.create_session() as session:
+        assert verifyBalances(session) == []
+        test_account = session.scalars(select(db.Account).where(db.Account.name == "Test", db.Account.userID == 1)).one()
+        assert accountBalance(session, test_account.id) == test_account.sold == 135
+        assert session.scalar(select(func.sum(db.LedgerEntry.amount))) == 0
+
+def test_transfer_batch():
+    target_iban = client.post("/account/infos", json={ "name": "Test", "userID": 1 }).json()["iban"]
+    response = client.post("/account/transfer/batch", json={ "userID": 1, "transfers": [
+        { "sold": 40, "name": "Principal", "iban": target_iban },
+        { "sold": 40, "name": "Principal", "iban": target_iban },
+        { "sold": 30, "name": "Principal", "iban": target_iban },
+        { "sold": 5, "name": "Missing", "iban": target_iban },
+        { "sold": 5, "name": "Principal", "iban": "nope" },
+    ]})
+    assert response.status_code == 200
+    json_response = response.json()
+    assert json_response["accepted"] == 2
+    assert [result.get("error") for result in json_response["results"]] == [
+        None, "This account isn't sold enough to make the transfer", None, "Account not found", "This IBAN does not exist"
+    ]
+    transfer_ids = [result["transferID"] for result in json_response["results"] if "transferID" in result]
+    info = client.post("/transfer/info", json={ "userID": 1, "transferID": transfer_ids[1] }).json()
+    assert info["amount"] == 30
+    assert info["status"] == "pending"
+    with db.create_session() as session:
+        inserted = session.execute(select(db.Transfer.id, db.Transfer.sold, db.Transfer.created_at).where(db.Transfer.id.in_(transfer_ids)).order_by(db.Transfer.id)).all()
+    assert [(row.id, row.sold) for row in inserted] == list(zip(transfer_ids, [40, 30]))
+    assert inserted[0].created_at == inserted[1].created_at
+
+"""
+Query plan tests
+"""
+
+@contextmanager
+def query_plans(*engines):
+    plans = []
+    def explain(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+            plans.append((statement, [row[3] for row in cursor.fetchall()]))
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", explain)
+    try:
+        yield plans
+    finally:
+        for engine in engines:
+            event.remove(engine, "before_cursor_execute", explain)
+
+def test_hot_queries_use_indexes():
+    client.post("/account/create", json={"name": "Test3", "userID": 1})
+    with query_plans(db.engine, db.async_engine.sync_engine) as plans:
+        client.post("/account/infos", json={ "name": "Test", "userID": 1 })
+        client.post("/account/close", json={ "name": "Test3", "userID": 1 })
+        client.post("/account/transaction_logs", json={ "name": "Test", "userID": 1 })
+        client.post("/account/transaction_logs", json={ "name": "Test", "userID": 1, "limit": 1 })
+        with db.create_session() as session:
+            settleTransfers(session)
+
+    assert plans
+    tables = SQLModel.metadata.tables
+    full_scans = [(statement, detail) for statement, plan in plans for detail in plan
+                  if detail.split()[0] == "SCAN" and detail.split()[1] in tables]
+    assert full_scans == []
+
 """
 Beneficiaries tests
 """
@@ -128,3 +420,501 @@ def test_get_beneficiaries():
     beneficiary = json_response[0]
     assert beneficiary["id"] == 1
     assert beneficiary["name"] =="Titouan"
+
+"""
+Legacy data tests
+"""
+
+def test_auth_login_rehashes_legacy_password():
+    with db.create_session() as session:
+        session.add(db.User(name="legacy", email="legacy@example.com", password=hashlib.sha256(b"legacypassword").hexdigest()))
+        session.commit()
+    response = client.post("/auth/login", json={ "email": "legacy@example.com", "password": "legacypassword" })
+    assert response.json()["message"] == "User logged in"
+    with db.create_session() as session:
+        user = session.scalars(select(db.User).where(db.User.email == "legacy@example.com")).one()
+        assert user.password.startswith("scrypt$")
+    assert client.post("/auth/login", json={ "email": "legacy@example.com", "password": "legacypassword" }).json()["message"] == "User logged in"
+
+"""
+Concurrency tests
+"""
+
+def test_concurrent_balance_updates():
+    with db.create_session() as session:
+        user = db.User(name="stress", email="stress@example.com", password="")
+        session.add(user)
+        session.flush()
+        hot = [db.Account(name=f"Hot {i}", sold=1000, reserved=100, userID=user.id, iban=f"FR76STRESS{i:04d}") for i in range(3)]
+        session.add_all(hot)
+        session.flush()
+        for account in hot:
+            postEntries(session, postingEntries(db.LedgerEntryKind.OPENING, account.sold, None, account.id))
+        # A ring of due transfers, so every hot account is both debited and credited while deposits land.
+        due = datetime.utcnow() - timedelta(minutes=1)
+        session.add_all([
+            db.Transfer(sold=1, userID=user.id, sourceAccountID=hot[i % 3].id, targetAccountID=hot[(i + 1) % 3].id, created_at=due)
+            for i in range(300)
+        ])
+        session.commit()
+        user_id, account_ids = user.id, [account.id for account in hot]
+
+    def deposit(worker):
+        async def run():
+            session = db.ThreadedSession(Session(db.engine, expire_on_commit=False))
+            try:
+                for i in range(60):
+                    account = await session.get(db.Account, account_ids[(worker + i) % 3])
+                    await addMoney(Decimal("0.01"), session, account)
+            finally:
+                await session.close()
+        asyncio.run(run())
+
+    def settle():
+        with db.create_session() as session:
+            return settleTransfers(session, batch_size=10).settled
+
+    with ThreadPoolExecutor(max_workers=9) as executor:
+        settler = executor.submit(settle)
+        list(executor.map(deposit, range(8)))
+        assert settler.result() >= 300
+
+    with db.create_session() as session:
+        balances = session.scalars(select(db.Account.sold).where(db.Account.id.in_(account_ids))).all()
+        assert balances == [Decimal("1001.60")] * 3
+        assert session.scalars(select(db.Account.reserved).where(db.Account.id.in_(account_ids))).all() == [0] * 3
+        pending = select(func.count()).select_from(db.Transfer).where(db.Transfer.userID == user_id, db.Transfer.status == db.TransferStatus.PENDING)
+        assert session.scalar(pending) == 0
+        assert verifyBalances(session) == []
+
+def test_settlement_scheduler(monkeypatch):
+    monkeypatch.setattr(settlement_scheduler, "clock", lambda: datetime.utcnow() + SETTLEMENT_DELAY)
+    target_iban = client.post("/account/infos", json={ "name": "Test", "userID": 1 }).json()["iban"]
+    settled_batches = settlement_lag_seconds.count()
+    settlement_scheduler.start()
+    try:
+        client.post("/account/deposit", json={ "name": "Principal", "userID": 1, "sold": 20 })
+        client.post("/account/transfer", json={ "sold": 20, "name": "Principal", "iban": target_iban, "userID": 1 })
+        with db.create_session() as session:
+            pending = select(func.count()).select_from(db.Transfer).where(db.Transfer.status == db.TransferStatus.PENDING)
+            for _ in range(50):
+                if session.scalar(pending) == 0:
+                    break
+                time.sleep(0.1)
+            assert session.scalar(pending) == 0
+    finally:
+        settlement_scheduler.stop()
+    assert len(settlement_scheduler) == 0
+    assert settlement_lag_seconds.count() > settled_batches
+
+def test_settlement_workers_share_transfers():
+    with db.create_session() as session:
+        user = db.User(name="lease", email="lease@example.com", password="")
+        session.add(user)
+        session.flush()
+        source = db.Account(name="Lease source", sold=500, reserved=400, userID=user.id, iban="FR76LEASE0001")
+        target = db.Account(name="Lease target", sold=0, userID=user.id, iban="FR76LEASE0002")
+        session.add_all([source, target])
+        session.flush()
+        postEntries(session, postingEntries(db.LedgerEntryKind.OPENING, source.sold, None, source.id))
+        due = datetime.utcnow() - timedelta(minutes=1)
+        session.add_all([db.Transfer(sold=1, userID=user.id, sourceAccountID=source.id, targetAccountID=target.id, created_at=due) for _ in range(400)])
+        session.commit()
+        source_id, target_id = source.id, target.id
+
+    now = datetime.utcnow()
+    with db.create_session() as session:
+        crashed = claimTransfers(session, "crashed", now - SETTLEMENT_DELAY, now, batch_size=50)
+    assert len(crashed) == 50
+
+    def settle(worker):
+        with db.create_session() as session:
+            return settleTransfers(session, now=now, batch_size=20, worker=worker).settled
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        assert sum(executor.map(settle, ["a", "b", "c", "d"])) == 350
+    # The crashed worker's batch waits for its lease to run out, then another worker takes it.
+    with db.create_session() as session:
+        assert settleTransfers(session, now=now + SETTLEMENT_LEASE, worker="a").settled == 50
+        assert session.get(db.Account, source_id).sold == 100
+        assert session.get(db.Account, source_id).reserved == 0
+        assert session.get(db.Account, target_id).sold == 400
+        assert verifyBalances(session) == []
+
+"""
+Query budget tests
+"""
+
+def statements_run(route: str, call):
+    """The response of call() and how many SQL statements the request to route ran, starting from cold caches."""
+    response_cache.backend.clear()
+    utils.principal_cache.clear()
+    idempotency_service.idempotency_cache.clear()
+    before = request_queries.sum(route=route)
+    response = call()
+    return response, request_queries.sum(route=route) - before
+
+def test_query_budgets():
+    assert all(hasattr(route.endpoint, "query_budget") for route in app.routes if isinstance(route, APIRoute))
+
+    principal_iban = client.post("/account/infos", json={ "name": "Principal", "userID": 1 }).json()["iban"]
+    client.post("/account/create", json={ "name": "Spare", "userID": 1 })
+    client.post("/account/create", json={ "name": "Funded", "userID": 1 })
+    client.post("/account/deposit", json={ "name": "Funded", "userID": 1, "sold": 5 })
+    with db.create_session() as session:
+        # Opened behind the directory's back, so the batch below has to look it up.
+        session.add(db.Account(name="Budget beneficiary", userID=2, iban="FR76BUDGET0001"))
+        session.commit()
+    token = client.post("/auth/login", json={ "email": "test@example.com", "password": "thisisatest" }).json()["access_token"]
+    budget = { "name": "Budget", "userID": 1 }
+    calls = [
+        ("/account/create", 3, lambda: client.post("/account/create", json=budget)),
+        ("/account/deposit", 9, lambda: client.post("/account/deposit", json={ **budget, "sold": 50 }, headers={ "Idempotency-Key": "budget-deposit" })),
+        ("/account/transfer", 7, lambda: client.post("/account/transfer", json={ **budget, "sold": 10, "iban": principal_iban }, headers={ "Idempotency-Key": "budget-transfer" })),
+        ("/transfer/last", 1, lambda: client.post("/transfer/last")),
+        ("/account/infos", 1, lambda: client.post("/account/infos", json=budget)),
+        ("/accounts/", 2, lambda: client.post("/accounts/", json={ "userID": 1 })),
+        ("/account/deposit_logs", 2, lambda: client.post("/account/deposit_logs", json=budget)),
+        ("/account/transaction_logs", 3, lambda: client.post("/account/transaction_logs", json=budget)),
+        ("/account/statements/export", 3, lambda: client.post("/account/statements/export", json={ "userID": 1 })),
+        ("/account/close", 4, lambda: client.post("/account/close", json={ "name": "Spare", "userID": 1 })),
+        # A funded account also moves its balance to the main one.
+        ("/account/close", 7, lambda: client.post("/account/close", json={ "name": "Funded", "userID": 1 })),
+        ("/users/{user_id}", 1, lambda: client.get("/users/1")),
+        ("/auth/register", 5, lambda: client.post("/auth/register", json={ "name": "budget", "email": "budget@example.com", "password": "thisisabudget" })),
+        ("/auth/login", 1, lambda: client.post("/auth/login", json={ "email": "test@example.com", "password": "thisisatest" })),
+        ("/auth/me", 1, lambda: client.get("/auth/me", headers={ "Authorization": f"Bearer {token}" })),
+        ("/beneficiary/add", 3, lambda: client.post("/beneficiary/add", json={ "name": "Lease", "iban": "FR76LEASE0001", "userID": 1 })),
+        ("/beneficiaries/{user_id}", 1, lambda: client.get("/beneficiaries/1")),
+        ("/account/summary", 2, lambda: client.post("/account/summary", json=budget)),
+        ("/beneficiary/batch", 3, lambda: client.post("/beneficiary/batch", json={ "userID": 1, "beneficiaries": [{ "name": "Budget", "iban": "FR76BUDGET0001" }] })),
+        ("/metrics", 0, lambda: client.get("/metrics")),
+    ]
+    budgets = {route.path: route.endpoint.query_budget for route in app.routes if isinstance(route, APIRoute)}
+    for route, expected, call in calls:
+        response, count = statements_run(route, call)
+        assert response.status_code == 200, (route, response.text)
+        assert "error" not in response.text[:10], (route, response.text)
+        # Exact, so a route that starts issuing a query per row fails here even while under its budget.
+        assert count == expected <= budgets[route], (route, count)
+
+    # A batch inserts all of its transfers in one statement, whatever its size.
+    batch_counts = []
+    for size in (2, 20):
+        transfers = [{ "sold": 1, "name": "Budget", "iban": principal_iban }] * size
+        response, count = statements_run("/account/transfer/batch", lambda: client.post("/account/transfer/batch", json={ "userID": 1, "transfers": transfers }))
+        batch_counts.append(count)
+    transfer_ids = [result["transferID"] for result in response.json()["results"]]
+    assert transfer_ids == sorted(transfer_ids)
+    assert batch_counts == [4, 4]
+
+    response, count = statements_run("/transfer/info", lambda: client.post("/transfer/info", json={ "userID": 1, "transferID": transfer_ids[0] }))
+    assert response.json()["source_account"] == "Budget" and response.json()["target_account"] == "Principal"
+    assert count == 1
+    response, count = statements_run("/transfer/canceled", lambda: client.post("/transfer/canceled", json={ "userID": 1, "transferID": transfer_ids[-1] }))
+    assert response.status_code == 200 and "error" not in response.json()
+
+"""
+Summary tests
+"""
+
+def test_account_summary():
+    client.post("/auth/register", json={ "name": "summary", "email": "summary@example.com", "password": "thisisasummary" })
+    with db.create_session() as session:
+        user_id = session.scalars(select(db.User.id).where(db.User.email == "summary@example.com")).one()
+    principal = { "name": "Principal", "userID": user_id }
+    savings = { "name": "Savings", "userID": user_id }
+    client.post("/account/create", json=savings)
+    target_iban = client.post("/account/infos", json=savings).json()["iban"]
+
+    client.post("/account/deposit", json={ **principal, "sold": "40.10" })
+    client.post("/account/transfer", json={ **principal, "sold": "30.05", "iban": target_iban })
+    client.post("/account/transfer", json={ **principal, "sold": 20, "iban": target_iban })
+    cancelled_id = client.post("/transfer/last").json()["id"]
+    assert client.post("/transfer/canceled", json={ "userID": user_id, "transferID": cancelled_id }).json() == {"message": "Transfer cancelled"}
+    # Cancelling twice doesn't take the transfer out of the pending totals twice.
+    client.post("/transfer/canceled", json={ "userID": user_id, "transferID": cancelled_id })
+
+    summary = client.post("/account/summary", json=principal).json()
+    today = datetime.utcnow().date()
+    assert summary["granularity"] == "month"
+    assert [period["period"] for period in summary["periods"]] == [today.replace(day=1).isoformat()]
+    assert summary["totals"]["deposits"] == 1 and Decimal(str(summary["totals"]["depositTotal"])) == Decimal("40.10")
+    assert summary["totals"]["pending"] == 1 and Decimal(str(summary["totals"]["pendingOut"])) == Decimal("30.05")
+    assert summary["totals"]["transfersOut"] == 0
+
+    with db.create_session() as session:
+        settleTransfers(session, now=datetime.utcnow() + SETTLEMENT_DELAY + timedelta(seconds=1))
+    summary = client.post("/account/summary", json={ **principal, "granularity": "day" }).json()
+    assert [period["period"] for period in summary["periods"]] == [today.isoformat()]
+    assert summary["totals"]["pending"] == 0 and Decimal(str(summary["totals"]["pendingOut"])) == 0
+    assert summary["totals"]["transfersOut"] == 1 and Decimal(str(summary["totals"]["outflow"])) == Decimal("30.05")
+    with db.create_session() as session:
+        assert session.scalars(select(db.Account.reserved).where(db.Account.userID == user_id)).all() == [0, 0]
+    target = client.post("/account/summary", json=savings).json()["totals"]
+    assert target["transfersIn"] == 1 and Decimal(str(target["inflow"])) == Decimal("30.05")
+
+    later = client.post("/account/summary", json={ **principal, "start_date": (today + timedelta(days=1)).isoformat() }).json()
+    assert later["periods"] == [] and later["totals"]["deposits"] == 0
+    assert client.post("/account/summary", json={ "name": "Missing", "userID": user_id }).json() == {"error": "Account not found"}
+
+"""
+Beneficiary directory tests
+"""
+
+def test_iban_directory():
+    directory = IbanDirectory()
+    with db.create_session() as session:
+        directory.load(session)
+        accounts = session.scalars(select(db.Account)).all()
+    assert len(directory) == len(accounts)
+    for account in accounts:
+        assert directory.get(account.iban) == (account.id, account.userID)
+    assert directory.get("FR76NOPE0000") is None
+
+    directory.add("FR76DIRECTORY1", 10_000, 1)
+    assert directory.get("FR76DIRECTORY1") == (10_000, 1)
+
+def test_beneficiary_batch():
+    with db.create_session() as session:
+        user_id = session.scalars(select(db.User.id).where(db.User.email == "summary@example.com")).one()
+    principal_iban = client.post("/account/infos", json={ "name": "Principal", "userID": user_id }).json()["iban"]
+    savings_iban = client.post("/account/infos", json={ "name": "Savings", "userID": user_id }).json()["iban"]
+    assert client.post("/account/close", json={ "name": "Savings", "userID": user_id }).json() == {"message": "Account closed"}
+    # The directory still knows the account; whether it is closed is read from the database.
+    assert iban_directory.get(savings_iban) is not None
+
+    own_iban = client.post("/account/infos", json={ "name": "Principal", "userID": 1 }).json()["iban"]
+    items = [
+        { "name": "Summary", "iban": principal_iban },
+        { "name": "Summary again", "iban": principal_iban },
+        { "name": "Myself", "iban": own_iban },
+        { "name": "Nobody", "iban": "FR76NOPE0000" },
+        { "name": "Closed", "iban": savings_iban },
+        { "name": "Lease", "iban": "FR76LEASE0002" },
+    ]
+    expected_errors = {
+        1: "This beneficiary already exists",
+        2: "The beneficiary account is the same as the user account",
+        3: "Beneficiary acccount not found",
+        4: "Beneficiary account is closed",
+    }
+    before = len(client.get("/beneficiaries/1").json())
+
+    checked = client.post("/beneficiary/batch", json={ "userID": 1, "beneficiaries": items, "validate_only": True }).json()
+    assert checked["accepted"] == 2
+    assert {result["index"]: result["error"] for result in checked["results"] if "error" in result} == expected_errors
+    assert len(client.get("/beneficiaries/1").json()) == before
+
+    imported = client.post("/beneficiary/batch", json={ "userID": 1, "beneficiaries": items }).json()
+    assert imported["accepted"] == 2
+    assert {beneficiary["name"] for beneficiary in client.get("/beneficiaries/1").json()} >= {"Summary", "Lease"}
+    assert len(client.get("/beneficiaries/1").json()) == before + 2
+
+    again = client.post("/beneficiary/batch", json={ "userID": 1, "beneficiaries": items }).json()
+    assert again["accepted"] == 0
+    assert [again["results"][i]["error"] for i in (0, 5)] == ["This beneficiary already exists"] * 2
+
+    response = client.post("/beneficiary/add", json={ "name": "Closed", "iban": savings_iban, "userID": 1 })
+    assert response.status_code == 400 and response.json()["detail"] == "Beneficiary account is closed"
+
+# The tables as the first release created them, amounts still floats.
+BASELINE_SCHEMA = """
+CREATE TABLE user (id INTEGER PRIMARY KEY, name VARCHAR NOT NULL, email VARCHAR(255) NOT NULL UNIQUE, password VARCHAR(255) NOT NULL);
+CREATE TABLE account (id INTEGER PRIMARY KEY, sold FLOAT NOT NULL, "userID" INTEGER NOT NULL REFERENCES user (id), iban VARCHAR(34) NOT NULL UNIQUE,
+    name VARCHAR NOT NULL, created_at DATETIME NOT NULL, "isMain" BOOLEAN NOT NULL, "isClosed" BOOLEAN NOT NULL);
+CREATE TABLE deposit (id INTEGER PRIMARY KEY, sold FLOAT NOT NULL, "userID" INTEGER NOT NULL REFERENCES user (id), "accountID" INTEGER NOT NULL REFERENCES account (id),
+    created_at DATETIME NOT NULL);
+CREATE TABLE transfer (id INTEGER PRIMARY KEY, sold FLOAT NOT NULL, "userID" INTEGER NOT NULL REFERENCES user (id), "sourceAccountID" INTEGER NOT NULL REFERENCES account (id),
+    "targetAccountID" INTEGER NOT NULL REFERENCES account (id), created_at DATETIME NOT NULL, status VARCHAR(9) NOT NULL);
+CREATE TABLE beneficiary (id INTEGER PRIMARY KEY, name VARCHAR NOT NULL, iban VARCHAR(34) NOT NULL, "userID" INTEGER NOT NULL REFERENCES user (id), created_at DATETIME NOT NULL);
+INSERT INTO user VALUES (1, 'old', 'old@example.com', 'x');
+INSERT INTO account VALUES (1, 69.95, 1, 'FR7600001', 'Principal', '2025-01-01 09:00:00.000000', 1, 0);
+INSERT INTO account VALUES (2, 10.05, 1, 'FR7600002', 'Savings', '2025-01-01 09:00:00.000000', 0, 0);
+INSERT INTO deposit VALUES (1, 30.0, 1, 1, '2025-01-02 09:00:00.000000');
+INSERT INTO transfer VALUES (1, 10.05, 1, 1, 2, '2025-01-03 09:00:00.000000', 'COMPLETED');
+INSERT INTO transfer VALUES (2, 5.0, 1, 1, 2, '2025-01-03 10:00:00.000000', 'CANCELLED');
+INSERT INTO transfer VALUES (3, 2.5, 1, 1, 2, '2025-01-04 09:00:00.000000', 'PENDING');
+"""
+
+def test_migrate_baseline_activity(tmp_path):
+    baseline = create_engine(f"sqlite:///{tmp_path / 'baseline.db'}")
+    with baseline.begin() as connection:
+        for statement in BASELINE_SCHEMA.split(";"):
+            if statement.strip():
+                connection.exec_driver_sql(statement)
+    SQLModel.metadata.create_all(baseline)
+    migrations.migrate(baseline)
+
+    with Session(baseline) as session:
+        def totals(account_id):
+            return summarize(session.scalars(activityRange(account_id, None, None)).all(), "month")["totals"]
+        completed = session.scalars(select(db.Transfer).where(db.Transfer.status == db.TransferStatus.COMPLETED)).all()
+        principal, savings = totals(1), totals(2)
+        assert principal["transfersOut"] == savings["transfersIn"] == len(completed) == 1
+        assert principal["outflow"] == savings["inflow"] == sum(transfer.sold for transfer in completed) == Decimal("10.05")
+        assert principal["pending"] == 1 and principal["pendingOut"] == Decimal("2.50")
+        assert principal["deposits"] == 1 and principal["depositTotal"] == Decimal("30.00")
+        assert session.scalars(select(db.Account.reserved).order_by(db.Account.id)).all() == [Decimal("2.50"), 0]
+
+"""
+Archive tests
+"""
+
+def test_archive_history(monkeypatch):
+    with db.create_session() as session:
+        user_id = session.scalars(select(db.User.id).where(db.User.email == "summary@example.com")).one()
+        account_id = session.scalars(select(db.Account.id).where(db.Account.userID == user_id, db.Account.name == "Principal")).one()
+        # Age the account's finished history past the horizon.
+        old = datetime.utcnow() - ARCHIVE_AFTER - timedelta(days=1)
+        involved = or_(db.Transfer.sourceAccountID == account_id, db.Transfer.targetAccountID == account_id)
+        session.execute(update(db.Transfer).where(involved, db.Transfer.status != db.TransferStatus.PENDING).values(created_at=old))
+        session.execute(update(db.Deposit).where(db.Deposit.accountID == account_id).values(created_at=old))
+        session.commit()
+    client.post("/account/deposit", json={ "name": "Principal", "userID": 1, "sold": 1 })
+
+    principal = { "name": "Principal", "userID": user_id }
+    def history():
+        return (
+            client.post("/account/transaction_logs", json={ **principal, "limit": 500 }).json(),
+            client.post("/account/statements/export", json={ "userID": user_id }).text,
+            client.post("/account/deposit_logs", json=principal).json(),
+            client.post("/account/summary", json=principal).json(),
+        )
+    before = history()
+
+    with db.create_session() as session:
+        result = archiveHistory(session)
+        assert result.transfers >= 2 and result.deposits >= 1
+        assert session.scalar(select(func.count()).select_from(db.Transfer).where(involved, db.Transfer.status != db.TransferStatus.PENDING)) == 0
+        assert session.scalar(select(func.count()).select_from(db.Deposit).where(db.Deposit.accountID == account_id)) == 0
+        archived_id = session.scalars(select(db.TransferArchive.id).where(
+            db.TransferArchive.sourceAccountID == account_id, db.TransferArchive.status == db.TransferStatus.COMPLETED
+        )).first()
+        assert verifyBalances(session) == []
+        assert archiveHistory(session).transfers == 0
+
+    assert history() == before
+    assert len(before[0]["transactions"]) == 4
+    info = client.post("/transfer/info", json={ "userID": user_id, "transferID": archived_id }).json()
+    assert info["status"] == "completed" and info["source_account"] == "Principal"
+    assert client.post("/transfer/canceled", json={ "userID": user_id, "transferID": archived_id }).json() == {"error": "Transfer already completed"}
+
+    # A range that starts after the newest archived row never reads the archive.
+    recent = { **principal, "start_date": (datetime.utcnow() - timedelta(days=1)).isoformat() }
+    response, count = statements_run("/account/transaction_logs", lambda: client.post("/account/transaction_logs", json=recent))
+    assert count == 3 and len(response.json()["transactions"]) == 1
+    response, count = statements_run("/account/transaction_logs", lambda: client.post("/account/transaction_logs", json=principal))
+    assert count == 4 and len(response.json()["transactions"]) == 4
+
+    # Raising the archive age later doesn't hide what was archived under the old one.
+    monkeypatch.setattr(archive_service, "ARCHIVE_AFTER", ARCHIVE_AFTER * 10)
+    around_archived = { **principal, "start_date": (old - timedelta(days=1)).isoformat() }
+    assert len(client.post("/account/transaction_logs", json=around_archived).json()["transactions"]) == 4
+    export = client.post("/account/statements/export", json={ "userID": user_id, "start_date": around_archived["start_date"] }).text
+    assert export.count('"account_name": "Principal"') == 4
+    with db.create_session() as session:
+        assert archiveHistory(session).transfers == 0
+
+"""
+Event stream tests
+"""
+
+def test_event_stream_websocket():
+    client.post("/auth/register", json={ "name": "events", "email": "events@example.com", "password": "thisisanevent" })
+    with db.create_session() as session:
+        user_id = session.scalars(select(db.User.id).where(db.User.email == "events@example.com")).one()
+    principal = { "name": "Principal", "userID": user_id }
+    spare = { "name": "Spare", "userID": user_id }
+    client.post("/account/create", json=spare)
+    spare_account = client.post("/account/infos", json=spare).json()
+    with db.create_session() as session:
+        spare_account["id"] = session.scalars(select(db.Account.id).where(db.Account.iban == spare_account["iban"])).one()
+
+    with client.websocket_connect(f"/events/ws?userID={user_id}") as user_events, \
+         client.websocket_connect(f"/events/ws?userID={user_id}&accountID={spare_account['id']}") as spare_events:
+        client.post("/account/deposit", json={ **principal, "sold": 50 })
+        balance = user_events.receive_json()
+        assert balance["type"] == "balance" and balance["sold"] == 150
+
+        client.post("/account/transfer", json={ **principal, "sold": 20, "iban": spare_account["iban"] })
+        created = user_events.receive_json()
+        assert created["type"] == "transfer" and created["status"] == "pending" and created["amount"] == 20
+        assert spare_events.receive_json() == created
+        client.post("/account/transfer", json={ **principal, "sold": 5, "iban": spare_account["iban"] })
+        cancelled_id = user_events.receive_json()["transferID"]
+        assert client.post("/transfer/canceled", json={ "userID": user_id, "transferID": cancelled_id }).json() == {"message": "Transfer cancelled"}
+        assert user_events.receive_json()["status"] == "cancelled"
+
+        with db.create_session() as session:
+            settleTransfers(session, now=datetime.utcnow() + SETTLEMENT_DELAY + timedelta(seconds=1))
+        completed = user_events.receive_json()
+        assert completed["transferID"] == created["transferID"] and completed["status"] == "completed"
+        balances = {event["accountID"]: event["sold"] for event in (user_events.receive_json(), user_events.receive_json())}
+        assert balances == {balance["accountID"]: 130, spare_account["id"]: 20}
+
+        # The stream narrowed to the spare account never saw the deposit to the principal one.
+        assert [spare_events.receive_json()["status"] for _ in range(3)] == ["pending", "cancelled", "completed"]
+        spare_balance = spare_events.receive_json()
+        assert spare_balance["accountID"] == spare_account["id"] and spare_balance["sold"] == 20
+    assert len(event_bus) == 0
+
+def test_event_bus_overflow():
+    async def scenario():
+        subscription = event_bus.subscribe(1, max_size=2)
+        for number in range(5):
+            event_bus.publish({"type": "test", "number": number}, {1}, {10})
+        event_bus.publish({"type": "test", "number": "elsewhere"}, {2}, {20})
+        await asyncio.sleep(0)
+        received = [await subscription.get(0.1) for _ in range(4)]
+        event_bus.unsubscribe(subscription)
+        return received
+    assert asyncio.run(scenario()) == [{"type": "overflow", "dropped": 3}, {"type": "test", "number": 3}, {"type": "test", "number": 4}, None]
+
+def test_event_stream_sse():
+    async def scenario():
+        subscription = event_bus.subscribe(1)
+        disconnected = asyncio.Event()
+        async def is_disconnected():
+            return disconnected.is_set()
+        stream = eventStream(subscription, is_disconnected, heartbeat=0.01)
+        event_bus.publish(balanceEvent(10, Decimal("12.50")), {1}, {10})
+        await asyncio.sleep(0)
+        chunks = [await anext(stream), await anext(stream)]
+        disconnected.set()
+        with pytest.raises(StopAsyncIteration):
+            await anext(stream)
+        return chunks, len(event_bus)
+    (event, heartbeat), subscribers = asyncio.run(scenario())
+    assert event.startswith("event: balance\ndata: ") and json.loads(event.split("data: ")[1])["sold"] == 12.5
+    assert heartbeat == ": heartbeat\n\n"
+    assert subscribers == 0
+
+def test_account_closed_by_another_worker():
+    with db.create_session() as session:
+        user_id = session.scalars(select(db.User.id).where(db.User.email == "conserve@example.com")).one()
+    client.post("/account/create", json={ "name": "Elsewhere", "userID": user_id })
+    target_iban = client.post("/account/infos", json={ "name": "Elsewhere", "userID": user_id }).json()["iban"]
+    client.post("/account/deposit", json={ "name": "Principal", "userID": 1, "sold": 5 })
+    assert client.post("/account/transfer", json={ "sold": 5, "name": "Principal", "iban": target_iban, "userID": 1 }).json() == {"message": ["Transfer done"]}
+
+    # Closed behind this process's back: its directory entry is untouched, as it would be on another worker.
+    with db.create_session() as session:
+        target_id = session.scalars(update(db.Account).where(db.Account.iban == target_iban).values(isClosed=True).returning(db.Account.id)).one()
+        session.commit()
+    assert iban_directory.get(target_iban).id == target_id
+
+    response = client.post("/account/transfer", json={ "sold": 1, "name": "Principal", "iban": target_iban, "userID": 1 })
+    assert response.json() == {"error": "Invalid transfer, the target account is closed"}
+    batch = client.post("/account/transfer/batch", json={ "userID": 1, "transfers": [{ "sold": 1, "name": "Principal", "iban": target_iban }] }).json()
+    assert batch["results"] == [{"index": 0, "error": "Invalid transfer, the target account is closed"}]
+    response = client.post("/beneficiary/add", json={ "name": "Elsewhere", "iban": target_iban, "userID": 1 })
+    assert response.status_code == 400 and response.json()["detail"] == "Beneficiary account is closed"
+
+    # The transfer accepted before the closure is cancelled at settlement rather than credited.
+    with db.create_session() as session:
+        result = settleTransfers(session, now=datetime.utcnow() + SETTLEMENT_DELAY + timedelta(seconds=1))
+        assert (result.settled, result.cancelled) == (0, 1)
+        assert session.scalars(select(db.Account.sold).where(db.Account.id == target_id)).one() == 0
+        assert session.scalars(select(db.Account.reserved).where(db.Account.userID == 1, db.Account.name == "Principal")).one() == 0
+        assert verifyBalances(session) == []
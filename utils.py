@@ -1,24 +1,31 @@
-import random
-import string
-from typing import Optional
+from typing import NamedTuple, Optional
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from datetime import timedelta, datetime
-from pytest import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from jose import JWTError, jwt
 from dotenv import load_dotenv
 import os
+import time
 import db
+from cache import TTLCache
 
 load_dotenv()
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", "60"))
+AUTH_TRUST_CLAIMS = os.getenv("AUTH_TRUST_CLAIMS", "0") == "1"
 
+class CurrentUser(NamedTuple):
+    id: int
+    email: str
+    name: str
 
-def generate_iban():
-    return ''.join(random.choices(string.digits, k=34))
+principal_cache = TTLCache(AUTH_CACHE_SIZE)
 
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
@@ -30,16 +37,33 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-def get_current_user(token: str = Depends(oauth2_scheme), db_session: Session = Depends(db.get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db_session: AsyncSession = Depends(db.get_async_db)):
+    """Résout l'utilisateur du token, depuis le cache tant que le token est valide."""
+    current_user = principal_cache.get(token)
+    if current_user is not None:
+        return current_user
+
     payload = verify_token(token)
     email = payload.get("sub")
     if email is None:
         raise HTTPException(status_code=401, detail="User not registred")
 
-    user = db_session.query(db.User).where(db.User.email == email).first()
-    if user is None:
-        raise HTTPException(status_code=404, detail="User not found")
-    return user
+    if AUTH_TRUST_CLAIMS and "uid" in payload:
+        current_user = CurrentUser(payload["uid"], email, payload.get("name", ""))
+    else:
+        user = (await db_session.scalars(select(db.User).where(db.User.email == email))).first()
+        if user is None:
+            raise HTTPException(status_code=404, detail="User not found")
+        current_user = CurrentUser(user.id, user.email, user.name)
+
+    # Capped by AUTH_CACHE_TTL: see TTLCache on changes made by other workers.
+    expires_at = min(payload["exp"], time.time() + AUTH_CACHE_TTL)
+    principal_cache.set(token, current_user, expires_at, tags=[("user", current_user.id)])
+    return current_user
+
+def invalidate_user(user_id: int):
+    """Oublie les tokens en cache d'un utilisateur modifié."""
+    principal_cache.invalidate_tag(("user", user_id))
 
 def verify_token(token: str):
     try: